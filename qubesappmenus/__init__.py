@@ -21,15 +21,21 @@
 # USA.
 
 """Handle menu entries for starting applications in qubes"""
+import concurrent.futures
 import contextlib
+import functools
 import subprocess
 import sys
 import os
 import os.path
 import shutil
 import logging
+import multiprocessing
+import threading
 
+import hashlib
 import itertools
+import json
 import importlib.resources
 import xdg.BaseDirectory
 
@@ -38,10 +44,46 @@ import qubesadmin.exc
 import qubesadmin.tools
 import qubesadmin.vm
 
-import qubesimgconverter
+
+import qubesappmenus.atomicfile
+import qubesappmenus.desktopmenu
+import qubesappmenus.desktoptemplate
+import qubesappmenus.iconindex
+import qubesappmenus.manifest
+import qubesappmenus.parallel
+import qubesappmenus.profiling
+import qubesappmenus.snapshot
+import qubesappmenus.templatecache
+import qubesappmenus.templateindex
+import qubesappmenus.tinting
 
 basedir = os.path.join(xdg.BaseDirectory.xdg_data_home, 'qubes-appmenus')
 
+def _listdir(path):
+    """List directory *path*, None if it does not exist"""
+    if not os.path.isdir(path):
+        return None
+    return os.listdir(path)
+
+def _link_or_copy(src, dst):
+    """Hard link *src* as *dst*, or copy it where links are not supported
+
+    :raise FileNotFoundError: *src* does not exist
+    """
+    try:
+        os.link(src, dst)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copy(src, dst)
+
+def _kbuildsycoca():
+    """Refresh KDE menu cache, when running in KDE"""
+    if 'KDE_SESSION_UID' in os.environ:
+        with qubesappmenus.profiling.profile.phase('subprocess:kbuildsycoca'):
+            subprocess.call(['kbuildsycoca' +
+                             os.environ.get('KDE_SESSION_VERSION', '4')])
+
 def vm_name_escape(vm_name: str) -> str:
     """Escape a VM name for use in a .desktop file name"""
     return ('_' + vm_name.replace('_', '_u')
@@ -67,6 +109,7 @@ class AppmenusSubdirs:
     icons_subdir = 'apps.icons'
     template_templates_subdir = 'apps-template.templates'
     whitelist = 'whitelisted-appmenus.list'
+    pending_icons = 'apps.icons.pending'
 
 
 class Appmenus(object):
@@ -76,12 +119,90 @@ class Appmenus(object):
     qubes_dispvm_desktop = 'org.qubes-os.dispvm'
     qubes_vm_desktop_settings = 'org.qubes-os.qubes-vm-settings'
 
+    def __init__(self, desktop_menu=None, tint_jobs=None, lazy_icons=False):
+        """
+        :param desktop_menu: backend registering files in the desktop menu,
+        see :py:mod:`qubesappmenus.desktopmenu`; chosen automatically if None
+        :param tint_jobs: number of processes tinting icons during updates,
+        number of available CPUs if None
+        :param lazy_icons: see :py:attr:`lazy_icons`
+        """
+        if desktop_menu is None:
+            desktop_menu = qubesappmenus.desktopmenu.default_desktop_menu()
+        self.desktop_menu = desktop_menu
+        self.tint_jobs = tint_jobs
+        self._tint_executor = None
+        self._tint_executor_lock = threading.Lock()
+        #: do not tint icons in :py:meth:`appicons_create` by default, only
+        #: reuse icons tinted for other VMs
+        self.lazy_icons = lazy_icons
+        #: names of VMs with icons left to tint by a non-lazy
+        #: :py:meth:`appicons_create` call, also marked on disk (see
+        #: :py:meth:`load_pending_icons`)
+        self.pending_icons = set()
+        self._template_index = None
+        #: parsed .desktop templates, for :py:meth:`get_available`
+        self.template_cache = qubesappmenus.templatecache.TemplateCache()
+        #: template path or name -> ((mtime, size), DesktopTemplate)
+        self._desktop_templates = {}
+        #: name of a template shipped with this package -> content hash
+        self._resource_digests = {}
+
+    def tint_executor(self, count):
+        """Pool of processes to tint *count* icons, or None to tint them in
+        the calling thread
+
+        The pool is started on first use and kept until :py:meth:`close`,
+        so a daemon serving many requests starts it only once. Worker
+        processes are started by a fork server, as the pool may be first
+        used by one of many threads (see :py:mod:`qubesappmenus.parallel`)
+        and forking a multi-threaded process is not safe.
+        """
+        jobs = self.tint_jobs
+        if jobs is None:
+            jobs = len(os.sched_getaffinity(0))
+        if jobs < 2 or count < 2:
+            return None
+        with self._tint_executor_lock:
+            if self._tint_executor is None:
+                self._tint_executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=jobs,
+                    mp_context=multiprocessing.get_context('forkserver'))
+            return self._tint_executor
+
+    def close(self):
+        """Stop processes started to tint icons, if any"""
+        with self._tint_executor_lock:
+            executor, self._tint_executor = self._tint_executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    @contextlib.contextmanager
+    def template_index(self):
+        """Resolve template chains and list template directories only once
+        within this context
+
+        See :py:class:`qubesappmenus.templateindex.TemplateIndex`.
+        """
+        if self._template_index is not None:
+            yield
+            return
+        self._template_index = qubesappmenus.templateindex.TemplateIndex()
+        try:
+            yield
+        finally:
+            self._template_index = None
+
     def templates_dirs(self, vm, template=None):
         """
 
         :type vm: qubes.vm.qubesvm.QubesVM
         :type template: qubes.vm.qubesvm.QubesVM
         """
+        if template is None and self._template_index is not None:
+            return [os.path.join(basedir, name,
+                                 AppmenusSubdirs.templates_subdir)
+                    for name in self._template_index.template_chain(vm)]
         dirs = []
         my_dir = os.path.join(basedir, vm.name,
                               AppmenusSubdirs.templates_subdir)
@@ -94,6 +215,10 @@ class Appmenus(object):
 
     def template_icons_dirs(self, vm):
         """Directory for not yet colore icons"""
+        if self._template_index is not None:
+            return [os.path.join(basedir, name,
+                                 AppmenusSubdirs.template_icons_subdir)
+                    for name in self._template_index.template_chain(vm)]
         dirs = []
         my_dir = os.path.join(basedir, vm.name,
                               AppmenusSubdirs.template_icons_subdir)
@@ -102,9 +227,13 @@ class Appmenus(object):
             dirs.extend(self.template_icons_dirs(vm.template))
         return dirs
 
-    @staticmethod
-    def template_for_file(template_dirs, name):
+    def template_for_file(self, template_dirs, name):
         """Find first template named *name* in *template_dirs*"""
+        if self._template_index is not None:
+            for tpl_dir in template_dirs:
+                if self._template_index.contains(tpl_dir, name):
+                    return os.path.join(tpl_dir, name)
+            return None
         for tpl_dir in template_dirs:
             path = os.path.join(tpl_dir, name)
             if os.path.exists(path):
@@ -125,6 +254,21 @@ class Appmenus(object):
         """File listing files wanted in menu"""
         return os.path.join(basedir, str(vm), AppmenusSubdirs.whitelist)
 
+    @staticmethod
+    def pending_icons_path(vm):
+        """File marking a VM with icons left to tint, see
+        :py:attr:`pending_icons`"""
+        return os.path.join(basedir, str(vm), AppmenusSubdirs.pending_icons)
+
+    def load_pending_icons(self):
+        """Add VMs with icons left to tint by an earlier process (for
+        example a daemon restarted before it tinted them) to
+        :py:attr:`pending_icons`"""
+        with contextlib.suppress(FileNotFoundError):
+            for vm_name in os.listdir(basedir):
+                if os.path.exists(self.pending_icons_path(vm_name)):
+                    self.pending_icons.add(vm_name)
+
     @staticmethod
     def directory_template_name(vm, dispvm):
         """File name of desktop directory entry template"""
@@ -143,50 +287,120 @@ class Appmenus(object):
         """Format .desktop/.directory file
 
         :param vm: QubesVM object for which write desktop file
-        :param source: desktop file template (path or template itself)
+        :param source: desktop file template (path, template itself or
+        :py:class:`qubesappmenus.desktoptemplate.DesktopTemplate`)
         :param destination_path: where to write the desktop file
         :param dispvm: create entries for launching in DispVM
         :return: True if target file was changed, otherwise False
         """
-        if source.startswith('/'):
-            with open(source, encoding='utf-8') as f_source:
-                source = f_source.read()
-        if dispvm:
-            if '\nX-Qubes-DispvmExec=' not in source and '\nExec=' in source:
-                raise DispvmNotSupportedError()
-            source = source. \
-                replace('\nExec=', '\nX-Qubes-NonDispvmExec='). \
-                replace('\nX-Qubes-DispvmExec=', '\nExec='). \
-                replace('\nName=%VMNAME%', '\nName=%VMNAME% (dvm)')
-        if dispvm:
+        if isinstance(source, str):
+            if source.startswith('/'):
+                with open(source, encoding='utf-8') as f_source:
+                    source = f_source.read()
+            source = qubesappmenus.desktoptemplate.DesktopTemplate(source)
+        if dispvm and source.dispvm is None:
+            raise DispvmNotSupportedError()
+        if not source.uses_icon:
+            # avoid querying the VM when not needed
+            icon = None
+        elif dispvm:
             # menu directory for creating new DispVMs is special
             icon = 'dispvm-' + vm.label.name
         else:
             icon = vm.icon
-        data = source. \
-            replace("%VMNAME%", vm.name). \
-            replace("%VMDIR%", os.path.join(basedir, vm.name)). \
-            replace("%XDGICON%", icon)
+        data = source.render(
+            (vm.name, os.path.join(basedir, vm.name), icon), dispvm)
         if os.path.exists(destination_path):
             with open(destination_path, encoding='utf-8') as dest_f:
                 current_dest = dest_f.read()
                 if current_dest == data:
+                    qubesappmenus.profiling.profile.count('files-unchanged')
                     return False
-        with open(destination_path, "w", encoding='utf-8') as dest_f:
-            dest_f.write(data)
+        qubesappmenus.atomicfile.write_file(destination_path, data)
+        qubesappmenus.profiling.profile.count('files-written')
         return True
 
+    def desktop_template(self, source):
+        """Compiled template, cached until the file changes
+
+        :param source: template path, or name of a template shipped with
+        this package
+        :rtype: qubesappmenus.desktoptemplate.DesktopTemplate
+        """
+        if source.startswith('/'):
+            stat = os.stat(source)
+            key = (stat.st_mtime_ns, stat.st_size)
+        else:
+            key = None
+        cached = self._desktop_templates.get(source)
+        if cached is None or cached[0] != key:
+            if source.startswith('/'):
+                with open(source, encoding='utf-8') as f_source:
+                    data = f_source.read()
+            else:
+                data = importlib.resources.files(__package__).joinpath(
+                    source).read_text()
+            cached = (key,
+                      qubesappmenus.desktoptemplate.DesktopTemplate(data))
+            self._desktop_templates[source] = cached
+        return cached[1]
+
+    def template_fingerprint(self, source):
+        """Identify version of a template, without reading it
+
+        :param source: like in :py:meth:`desktop_template`
+        :return: JSON-serializable value, different when the template
+        changes
+        """
+        if source.startswith('/'):
+            stat = os.stat(source)
+            return [source, stat.st_mtime_ns, stat.st_size]
+        try:
+            digest = self._resource_digests[source]
+        except KeyError:
+            digest = hashlib.sha256(importlib.resources.files(
+                __package__).joinpath(source).read_bytes()).hexdigest()
+            self._resource_digests[source] = digest
+        return [source, digest]
+
+    def _write_entry(self, vm, manifest, inputs, source, destination_path,
+                     *, dispvm=False, force=False):
+        """Write desktop file, unless *manifest* records the same
+        *inputs* for it and the file exists
+
+        :param inputs: values the file depends on, besides the template
+        :param force: compare with the file even if inputs are unchanged
+        :return: True if target file was changed, otherwise False
+        """
+        name = os.path.basename(destination_path)
+        digest = qubesappmenus.manifest.inputs_digest(
+            [self.template_fingerprint(source), inputs, dispvm])
+        if not force and manifest.get(name) == digest and \
+                os.path.exists(destination_path):
+            qubesappmenus.profiling.profile.count('files-skipped')
+            return False
+        qubesappmenus.profiling.profile.count('files-rendered')
+        try:
+            changed = self.write_desktop_file(
+                vm, self.desktop_template(source), destination_path, dispvm)
+        except DispvmNotSupportedError:
+            manifest.discard(name)
+            raise
+        manifest.set(name, digest)
+        return changed
+
     def get_available_filenames(self, vm, template=None):
         """Yield filenames of available .desktop files"""
-        templates_dirs = self.templates_dirs(vm, template)
-        templates_dirs = (x for x in templates_dirs if os.path.isdir(x))
-        if not templates_dirs:
-            return
-
+        if self._template_index is not None:
+            listdir = self._template_index.listdir
+        else:
+            listdir = _listdir
         listed = set()
-        for template_dir in templates_dirs:
-            for filename in os.listdir(template_dir):
-                if filename in listed:
+        for template_dir in self.templates_dirs(vm, template):
+            for filename in listdir(template_dir) or ():
+                # hidden files include temporary files of
+                # atomicfile.write_file
+                if filename in listed or filename.startswith('.'):
                     continue
                 listed.add(filename)
                 yield os.path.join(template_dir, filename)
@@ -197,34 +411,17 @@ class Appmenus(object):
         Returns a generator of lists that contain fields to be outputted"""
         # TODO icon path (#2885)
         for filename in self.get_available_filenames(vm, template):
-            field_values = {}
-            with open(filename, encoding='utf-8') as file:
-                name = None
-                main_section = False
-                for line in file:
-                    if line.startswith('['):
-                        main_section = line == '[Desktop Entry]\n'
-                        continue
-                    if not main_section:
-                        continue
-                    if '=' not in line:
-                        continue
-                    if line.startswith('Name=%VMNAME%: '):
-                        name = line.partition('Name=%VMNAME%: ')[2].strip()
-                        if not fields:
-                            break
-                    if fields:
-                        [field_name, value] = \
-                            [x.strip() for x in line.split('=', 1)]
-                        if field_name in fields:
-                            field_values[field_name] = value
-            if name is None:
+            names, field_values = self.template_cache.get(filename)
+            if not names:
                 continue
+            # without fields, the first name is enough
+            name = names[-1] if fields else names[0]
             result = [os.path.basename(filename), name]
             if fields:
                 for field in fields:
                     result.append(field_values.get(field, ''))
             yield result
+        self.template_cache.save()
 
     def desktop_name(self, vm, appmenu_basename: str, dispvm=False):
         """Return the basename of a ``.desktop`` file.
@@ -273,15 +470,12 @@ class Appmenus(object):
                 appmenus_to_remove_fnames = [os.path.join(appmenus_dir, x)
                                              for x in bad_menus]
                 try:
-                    desktop_menu_cmd = ['xdg-desktop-menu', 'uninstall']
-                    if not refresh_cache:
-                        desktop_menu_cmd.append('--noupdate')
-                    desktop_menu_cmd.extend(appmenus_to_remove_fnames)
-                    desktop_menu_env = os.environ.copy()
-                    desktop_menu_env['LC_COLLATE'] = 'C'
-                    subprocess.check_call(desktop_menu_cmd,
-                                          env=desktop_menu_env)
-                except subprocess.CalledProcessError:
+                    with qubesappmenus.profiling.profile.phase(
+                            'desktop-menu'):
+                        self.desktop_menu.uninstall(
+                            appmenus_to_remove_fnames,
+                            refresh_cache=refresh_cache)
+                except (subprocess.CalledProcessError, OSError):
                     if hasattr(vm, 'log'):
                         vm.log.warning(
                             "Problem removing appmenus for %s", vm.name)
@@ -292,6 +486,7 @@ class Appmenus(object):
                             file=sys.stderr)
 
 
+    @qubesappmenus.profiling.profiled('appmenus_create')
     def appmenus_create(self, vm, force=False, refresh_cache=True):
         """Create/update .desktop files
 
@@ -316,13 +511,15 @@ class Appmenus(object):
         except (qubesadmin.exc.QubesDaemonNoResponseError,
                 qubesadmin.exc.QubesNoSuchPropertyError):
             dispvm = False
-        self._appmenus_create_onedir(
-            vm, force=force, refresh_cache=refresh_cache, dispvm=False,
-            keep_dispvm=dispvm)
-
-        if dispvm:
+        with qubesappmenus.atomicfile.sync_batch():
             self._appmenus_create_onedir(
-                vm, force=force, refresh_cache=refresh_cache, dispvm=True)
+                vm, force=force, refresh_cache=refresh_cache, dispvm=False,
+                keep_dispvm=dispvm)
+
+            if dispvm:
+                self._appmenus_create_onedir(
+                    vm, force=force, refresh_cache=refresh_cache,
+                    dispvm=True)
 
     def _appmenus_create_onedir(self, vm, *, force=False, refresh_cache=True,
                                 dispvm=False, keep_dispvm=False):
@@ -342,16 +539,18 @@ class Appmenus(object):
         if not os.path.exists(appmenus_dir):
             os.makedirs(appmenus_dir)
 
+        manifest = qubesappmenus.manifest.Manifest(appmenus_dir)
+        # everything besides templates that affects generated files
+        inputs = [vm.name, os.path.join(basedir, vm.name), vm.icon,
+                  vm.label.name]
+
         anything_changed = False
         directory_changed = False
         directory_file = self._directory_path(vm, dispvm=dispvm)
-        data = importlib.resources.files(__package__).joinpath(
-            self.directory_template_name(vm, dispvm)).read_text()
-        if self.write_desktop_file(
-                vm,
-                data,
-                directory_file,
-                dispvm):
+        if self._write_entry(
+                vm, manifest, inputs,
+                self.directory_template_name(vm, dispvm),
+                directory_file, dispvm=dispvm, force=force):
             anything_changed = True
             directory_changed = True
         appmenus = list(self.get_available_filenames(vm))
@@ -370,7 +569,8 @@ class Appmenus(object):
                                  self.desktop_name(vm, appmenu_basename,
                                                    dispvm=dispvm))
             try:
-                if self.write_desktop_file(vm, appmenu, fname, dispvm):
+                if self._write_entry(vm, manifest, inputs, appmenu, fname,
+                                     dispvm=dispvm, force=force):
                     changed_appmenus.append(fname)
             except DispvmNotSupportedError:
                 # remove DispVM-incompatible entries
@@ -384,12 +584,10 @@ class Appmenus(object):
         if not dispvm:
             vm_settings_fname = os.path.join(
                 appmenus_dir, self.settings_name(vm))
-            data = importlib.resources.files(__package__).joinpath(
-                'qubes-vm-settings.desktop.template').read_text()
-            if self.write_desktop_file(
-                    vm,
-                    data,
-                    vm_settings_fname):
+            if self._write_entry(
+                    vm, manifest, inputs,
+                    'qubes-vm-settings.desktop.template',
+                    vm_settings_fname, force=force):
                 changed_appmenus.append(vm_settings_fname)
             target_appmenus.append(os.path.basename(vm_settings_fname))
 
@@ -397,7 +595,9 @@ class Appmenus(object):
             anything_changed = True
 
         # remove old entries
-        installed_appmenus = os.listdir(appmenus_dir)
+        # skip temporary files of concurrent atomicfile.write_file
+        installed_appmenus = [x for x in os.listdir(appmenus_dir)
+                              if not x.startswith('.')]
         installed_appmenus.remove(os.path.basename(directory_file))
         appmenus_to_remove = set(installed_appmenus).difference(set(
             target_appmenus))
@@ -423,40 +623,36 @@ class Appmenus(object):
                 os.unlink(appmenu)
             except FileNotFoundError:
                 pass
+            manifest.discard(os.path.basename(appmenu))
+        manifest.save()
 
         # add new entries
         if anything_changed or force:
-            # Only call ‘xdg-desktop-menu’ if it has at least one file argument
+            # Only install if there is at least one file argument
             do_anything = False
             try:
-                desktop_menu_cmd = ['xdg-desktop-menu', 'install']
-                if not refresh_cache:
-                    desktop_menu_cmd.append('--noupdate')
-                desktop_menu_cmd.append(directory_file)
+                desktop_menu_files = [directory_file]
                 if (directory_changed and not changed_appmenus) or force:
                     # only directory file changed, not actual entries;
                     # re-register all of them to force refresh
                     if target_appmenus:
-                        desktop_menu_cmd.extend(
+                        desktop_menu_files.extend(
                             os.path.join(appmenus_dir, x)
                             for x in target_appmenus)
                         do_anything = True
                 elif changed_appmenus:
-                    desktop_menu_cmd.extend(changed_appmenus)
+                    desktop_menu_files.extend(changed_appmenus)
                     do_anything = True
                 if do_anything:
-                    desktop_menu_env = os.environ.copy()
-                    desktop_menu_env['LC_COLLATE'] = 'C'
-                    subprocess.check_call(
-                        desktop_menu_cmd,
-                        env=desktop_menu_env)
-            except subprocess.CalledProcessError:
+                    with qubesappmenus.profiling.profile.phase(
+                            'desktop-menu'):
+                        self.desktop_menu.install(desktop_menu_files,
+                                                  refresh_cache=refresh_cache)
+            except (subprocess.CalledProcessError, OSError):
                 vm.log.warning("Problem creating appmenus for %s", vm.name)
 
         if refresh_cache:
-            if 'KDE_SESSION_UID' in os.environ:
-                subprocess.call(['kbuildsycoca' +
-                                 os.environ.get('KDE_SESSION_VERSION', '4')])
+            _kbuildsycoca()
 
     @staticmethod
     def _is_old_path(name):
@@ -482,6 +678,7 @@ class Appmenus(object):
         return os.path.join(self.appmenus_dir(vm),
                             basename + vm_name_escape(str(vm)) + '.directory')
 
+    @qubesappmenus.profiling.profiled('appmenus_remove')
     def appmenus_remove(self, vm, refresh_cache=True):
         """Remove desktop files for particular VM
 
@@ -500,13 +697,12 @@ class Appmenus(object):
             self._do_remove_appmenus(vm, installed_appmenus, appmenus_dir,
                     refresh_cache)
             shutil.rmtree(appmenus_dir)
+        qubesappmenus.manifest.Manifest.remove(appmenus_dir)
 
         self._remove_menu_files(vm)
 
         if refresh_cache:
-            if 'KDE_SESSION_UID' in os.environ:
-                subprocess.call(['kbuildsycoca' +
-                                 os.environ.get('KDE_SESSION_VERSION', '4')])
+            _kbuildsycoca()
 
     @staticmethod
     def _remove_menu_files(vm):
@@ -531,8 +727,16 @@ class Appmenus(object):
                                        'user-' + prefix + '-' +
                                        vm_name + '.menu'))
 
-    def appicons_create(self, vm, srcdirs=(), force=False):
-        """Create/update applications icons"""
+    @qubesappmenus.profiling.profiled('appicons_create')
+    def appicons_create(self, vm, srcdirs=(), force=False, lazy=None):
+        """Create/update applications icons
+
+        :param lazy: only link icons already tinted for another VM, leave
+        the others for a later non-lazy call (VM name is added to
+        :py:attr:`pending_icons`); :py:attr:`lazy_icons` if None
+        """
+        if lazy is None:
+            lazy = self.lazy_icons
         if not srcdirs:
             srcdirs = self.template_icons_dirs(vm)
         if not srcdirs:
@@ -559,28 +763,165 @@ class Appmenus(object):
             os.unlink(dstdir)
             os.makedirs(dstdir)
 
+        if self._template_index is not None:
+            listdir = self._template_index.listdir
+        else:
+            listdir = _listdir
         if whitelist:
             expected_icons = [os.path.splitext(x)[0] + '.png'
                               for x in whitelist]
         else:
             expected_icons = list(itertools.chain.from_iterable(
-                os.listdir(srcdir)
-                for srcdir in srcdirs
-                if os.path.exists(srcdir)))
+                listdir(srcdir) or () for srcdir in srcdirs))
 
+        # icons tinted from the same content with the same color are left
+        # alone, even when forced; without a known hash fall back to mtime
+        icon_index = qubesappmenus.iconindex.IconIndex(dstdir)
+        if self._template_index is not None:
+            src_icon_index = self._template_index.icon_index
+        else:
+            src_icon_index = qubesappmenus.iconindex.IconIndex
+        src_indexes = {os.path.normpath(srcdir): src_icon_index(srcdir)
+                       for srcdir in srcdirs}
+        # destination -> source, all tinted in one batch
+        to_tint = {}
+        # (shared icon, its source, icon in dstdir)
+        to_link = []
+        # no longer used shared icons, to release once replaced
+        old_tinted_icons = []
+        # some icons left for later, see lazy_icons
+        deferred = False
+        unchanged = 0
         for icon in expected_icons:
             src_icon = self.template_for_file(srcdirs, icon)
             if not src_icon:
                 continue
 
             dst_icon = os.path.join(dstdir, icon)
-            if not os.path.exists(dst_icon) or force or \
-                    os.path.getmtime(src_icon) > os.path.getmtime(dst_icon):
-                qubesimgconverter.tint(src_icon, dst_icon, vm.label.color)
+            src_hash = src_indexes[
+                os.path.normpath(os.path.dirname(src_icon))].get(icon)
+            if src_hash is not None:
+                tinted = {'hash': src_hash, 'color': vm.label.color}
+                need_tint = not os.path.exists(dst_icon) or \
+                    icon_index.get(icon) != tinted
+            else:
+                tinted = None
+                need_tint = not os.path.exists(dst_icon) or force or \
+                    os.path.getmtime(src_icon) > os.path.getmtime(dst_icon)
+            old_tinted = icon_index.get(icon)
+            if need_tint and tinted is not None:
+                store_path = self.tinted_icon_path(tinted)
+                if not os.path.exists(store_path):
+                    if lazy:
+                        deferred = True
+                        continue
+                    os.makedirs(self.tinted_icons_dir(), exist_ok=True)
+                    to_tint.setdefault(store_path, src_icon)
+                to_link.append((store_path, src_icon, dst_icon))
+            elif need_tint and lazy:
+                deferred = True
+                continue
+            elif need_tint:
+                # do not write through a link to the shared store
+                if os.path.lexists(dst_icon):
+                    os.unlink(dst_icon)
+                to_tint[dst_icon] = src_icon
+            else:
+                unchanged += 1
+            if tinted is not None:
+                icon_index.set(icon, tinted)
+            else:
+                icon_index.discard(icon)
+            if old_tinted != tinted:
+                old_tinted_icons.append(old_tinted)
+
+        qubesappmenus.profiling.profile.count('icons-unchanged', unchanged)
+        qubesappmenus.profiling.profile.count('icons-linked', len(to_link))
+        self._tint_icons(vm.label.color, to_tint)
+        for store_path, src_icon, dst_icon in to_link:
+            self._link_tinted_icon(vm.label.color, store_path, src_icon,
+                                   dst_icon)
+        for old_tinted in old_tinted_icons:
+            self._release_tinted_icon(old_tinted)
+        pending_path = self.pending_icons_path(vm)
+        if deferred:
+            self.pending_icons.add(vm.name)
+            if not os.path.exists(pending_path):
+                with open(pending_path, 'w', encoding='utf-8'):
+                    pass
+        else:
+            self.pending_icons.discard(vm.name)
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(pending_path)
 
         for icon in os.listdir(dstdir):
             if icon not in expected_icons:
                 os.unlink(os.path.join(dstdir, icon))
+                self._release_tinted_icon(icon_index.get(icon))
+                icon_index.discard(icon)
+        icon_index.save()
+
+    @staticmethod
+    def tinted_icons_dir():
+        """Tinted icons shared by all VMs, named by source icon hash and
+        label color"""
+        return os.path.join(basedir, '.tinted-icons')
+
+    def tinted_icon_path(self, tinted):
+        """Path of the shared icon tinted as described by *tinted* (dict
+        with 'hash' and 'color' keys), or None if *tinted* is invalid"""
+        if not isinstance(tinted, dict) or \
+                set(tinted) != {'hash', 'color'}:
+            return None
+        return os.path.join(self.tinted_icons_dir(),
+                            '{hash}-{color}.png'.format(**tinted))
+
+    def _tint_icons(self, color, to_tint):
+        """Tint icons (dict of destination -> source path) with *color*,
+        replacing each destination only once it is complete"""
+        if not to_tint:
+            return
+        # keep .png extension, it selects the image format; shared icons
+        # may be tinted by other threads at the same time
+        tmp_paths = {dst: '{}.{}.{}.tmp.png'.format(
+                         dst, os.getpid(), threading.get_ident())
+                     for dst in to_tint}
+        qubesappmenus.profiling.profile.count('icons-tinted', len(to_tint))
+        with qubesappmenus.profiling.profile.phase('tint'):
+            qubesappmenus.tinting.tint_many(
+                color,
+                [(src, tmp_paths[dst]) for dst, src in to_tint.items()],
+                executor=self.tint_executor(len(to_tint)))
+        for dst, tmp_path in tmp_paths.items():
+            os.replace(tmp_path, dst)
+
+    def _link_tinted_icon(self, color, store_path, src_icon, dst_icon):
+        """Make *dst_icon* a link to the shared tinted icon *store_path*
+
+        The shared icon may be released by an update of another VM (in
+        another thread or process) since it was found, in which case it is
+        tinted again from *src_icon* with *color*.
+        """
+        tmp_path = dst_icon + '.tmp'
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        try:
+            _link_or_copy(store_path, tmp_path)
+        except FileNotFoundError:
+            self._tint_icons(color, {store_path: src_icon})
+            _link_or_copy(store_path, tmp_path)
+        os.replace(tmp_path, dst_icon)
+
+    def _release_tinted_icon(self, tinted):
+        """Remove shared tinted icon if no VM links to it anymore"""
+        store_path = self.tinted_icon_path(tinted)
+        if store_path is None:
+            return
+        try:
+            if os.stat(store_path).st_nlink == 1:
+                os.unlink(store_path)
+        except FileNotFoundError:
+            pass
 
     def appicons_remove(self, vm):
         """Remove icons
@@ -588,10 +929,29 @@ class Appmenus(object):
         Warning: vm may be either QubesVM object, or just its name (str).
         Actual VM may be already removed at this point.
         """
-        if not os.path.exists(self.icons_dir(vm)):
-            return
-        shutil.rmtree(self.icons_dir(vm))
+        icon_index = qubesappmenus.iconindex.IconIndex(self.icons_dir(vm))
+        icon_index.remove(self.icons_dir(vm))
+        if os.path.exists(self.icons_dir(vm)):
+            shutil.rmtree(self.icons_dir(vm))
+        for tinted in icon_index.entries.values():
+            self._release_tinted_icon(tinted)
+
+    def appmenus_purge(self, vm):
+        """Remove desktop files, icons and all other appmenus data of a VM
+
+        Warning: vm may be either QubesVM object, or just its name (str).
+        Actual VM may be already removed at this point.
+        """
+        self.appmenus_remove(vm)
+        self.appicons_remove(vm)
+        try:
+            shutil.rmtree(os.path.join(basedir, str(vm)))
+        except FileNotFoundError:
+            pass
+        if self._template_index is not None:
+            self._template_index.invalidate()
 
+    @qubesappmenus.profiling.profiled('appmenus_init')
     def appmenus_init(self, vm, src=None):
         """Initialize directory structure on VM creation, copying appropriate
         data from VM template if necessary
@@ -666,6 +1026,9 @@ class Appmenus(object):
                     shutil.copy(os.path.join(src_dir, filename),
                                 own_template_icons_dir)
 
+        if self._template_index is not None:
+            self._template_index.invalidate()
+
     @staticmethod
     def set_default_whitelist(vm, applications_list):
         """Update default applications list for VMs created on this template
@@ -715,29 +1078,118 @@ class Appmenus(object):
                     continue
                 yield line
 
-    def appmenus_update(self, vm, force=False):
-        """Update (regenerate) desktop files and icons for this VM and (in
-        case of template) child VMs"""
+    def _appmenus_update_vm(self, vm, force=False):
+        """Regenerate desktop files and icons of a single VM, without
+        refreshing desktop environment cache"""
         if not os.path.exists(os.path.join(basedir, vm.name)):
             self.appmenus_init(vm)
         self.appicons_create(vm, force=force)
         self.appmenus_create(vm, force=force, refresh_cache=False)
-        if hasattr(vm, 'appvms'):
-            for child_vm in vm.appvms:
-                if getattr(child_vm, 'guivm') != vm.app.local_name:
+
+    def _appmenus_update_children(self, vm, force=False, skip=()):
+        """Regenerate desktop files and icons of VMs based on template *vm*,
+        without refreshing desktop environment cache
+
+        :param skip: names of VMs to skip, as already regenerated
+        :return: list of names of regenerated VMs
+        """
+        updated = []
+        for child_vm in self._children_to_update(vm, skip=skip):
+            self._appmenus_update_child(child_vm, force=force)
+            updated.append(child_vm.name)
+        return updated
+
+    @staticmethod
+    def _children_to_update(vm, skip=()):
+        """VMs based on template *vm* with menu in this GUI VM, except those
+        named in *skip*"""
+        if not hasattr(vm, 'appvms'):
+            return []
+        children = {}
+        for child_vm in vm.appvms:
+            if child_vm.name in skip or child_vm.name in children:
+                continue
+            if getattr(child_vm, 'guivm') != vm.app.local_name:
+                continue
+            children[child_vm.name] = child_vm
+        return list(children.values())
+
+    def _appmenus_update_child(self, child_vm, force=False):
+        """Regenerate desktop files and icons of a VM based on an updated
+        template, logging failures"""
+        try:
+            self.appicons_create(child_vm, force=force)
+            self.appmenus_create(child_vm, refresh_cache=False)
+        except Exception as e:  # pylint: disable=broad-except
+            child_vm.log.error("Failed to recreate appmenus for "
+                               "'{0}': {1}".format(child_vm.name, str(e)))
+
+    def refresh_desktop_cache(self):
+        """Refresh desktop environment menu cache"""
+        with qubesappmenus.profiling.profile.phase('desktop-menu'):
+            self.desktop_menu.forceupdate()
+        _kbuildsycoca()
+
+    @qubesappmenus.profiling.profiled('appmenus_update')
+    def appmenus_update(self, vm, force=False, refresh_cache=True):
+        """Update (regenerate) desktop files and icons for this VM and (in
+        case of template) child VMs
+
+        :param refresh_cache: refresh desktop environment cache; if false,
+        must be refreshed manually later
+        """
+        with self.template_index(), qubesappmenus.atomicfile.sync_batch():
+            self._appmenus_update_vm(vm, force=force)
+            self._appmenus_update_children(vm, force=force, skip=(vm.name,))
+        if refresh_cache:
+            self.refresh_desktop_cache()
+
+    @qubesappmenus.profiling.profiled('appmenus_update_batch')
+    def appmenus_update_batch(self, vms, force=False, jobs=1):
+        """Update (regenerate) desktop files and icons for many VMs
+
+        Equivalent to calling :py:meth:`appmenus_update` for each of *vms*,
+        but every VM is regenerated only once, even if it is both listed
+        directly and based on a listed template, and desktop environment
+        cache is refreshed only once at the end.
+
+        :param jobs: number of VMs regenerated in parallel, see
+        :py:func:`qubesappmenus.parallel.process_qubes`
+        """
+        vms = list(vms)
+        updated = set()
+        with self.template_index(), qubesappmenus.atomicfile.sync_batch():
+            tasks = []
+            for vm in vms:
+                if vm.name in updated:
                     continue
-                try:
-                    self.appicons_create(child_vm, force=force)
-                    self.appmenus_create(child_vm, refresh_cache=False)
-                except Exception as e:  # pylint: disable=broad-except
-                    child_vm.log.error("Failed to recreate appmenus for "
-                                       "'{0}': {1}".format(child_vm.name,
-                                                           str(e)))
-        subprocess.call(['xdg-desktop-menu', 'forceupdate'])
-        if 'KDE_SESSION_UID' in os.environ:
-            subprocess.call([
-                'kbuildsycoca' + os.environ.get('KDE_SESSION_VERSION', '4')])
+                tasks.append((vm, functools.partial(
+                    self._appmenus_update_vm, force=force)))
+                updated.add(vm.name)
+            for vm in vms:
+                for child_vm in self._children_to_update(vm, skip=updated):
+                    tasks.append((child_vm, functools.partial(
+                        self._appmenus_update_child, force=force)))
+                    updated.add(child_vm.name)
+            qubesappmenus.parallel.process_qubes(tasks, jobs)
+        self.refresh_desktop_cache()
+
+    @qubesappmenus.profiling.profiled('appmenus_create_batch')
+    def appmenus_create_batch(self, vms, force=False, jobs=1):
+        """Create/update desktop files and icons for many VMs, up to *jobs*
+        in parallel, refreshing desktop environment cache only once at the
+        end
+
+        See :py:func:`qubesappmenus.parallel.process_qubes`.
+        """
+        def create(vm):
+            self.appicons_create(vm, force=force)
+            self.appmenus_create(vm, refresh_cache=False)
 
+        with self.template_index():
+            qubesappmenus.parallel.process_qubes(
+                [(vm, create) for vm in vms], jobs)
+        self.refresh_desktop_cache()
 
 parser = qubesadmin.tools.QubesArgumentParser(show_forceroot=True)
 
@@ -783,6 +1235,10 @@ parser.add_argument(
 parser.add_argument(
     '--force', action='store_true', default=False,
     help='Force refreshing files, even when looks up to date')
+parser.add_argument(
+    '--xdg-desktop-menu', action='store_true', default=False,
+    help='Register menu entries using the xdg-desktop-menu tool instead of '
+         'the built-in implementation')
 parser.add_argument(
     '--i-understand-format-is-unstable', dest='fool',
     action='store_true',
@@ -792,6 +1248,21 @@ parser.add_argument(
     help='File field to append to output for --get-available; can be used'
          ' multiple times for multiple fields. This option changes output'
          ' format to pipe-("|") separated.')
+parser.add_argument(
+    '--json', action='store_true', default=False,
+    help='Output results of --get-available, --get-whitelist and '
+         '--get-default-whitelist as JSON, one record per line')
+parser.add_argument(
+    '--profile', nargs='?', const='text',
+    choices=qubesappmenus.profiling.FORMATS, default=None,
+    help='Print durations of processing phases and event counters to '
+         'stderr at the end, as text (default) or JSON; also enabled by '
+         'the {} environment variable'.format(
+             qubesappmenus.profiling.ENV_VAR))
+parser.add_argument(
+    '--jobs', metavar='N', type=int, default=1,
+    help='Number of qubes processed in parallel for --create and --update '
+         '(default: 1)')
 parser.add_argument(
     '--template', action='store',
     help='Use the following template for listed domains instead of their '
@@ -817,77 +1288,152 @@ def retrieve_list(path):
         return [x.rstrip() for x in file.readlines()]
 
 
+def print_json_records(appmenus, vm, args):
+    """Print results of --get-* options for a single VM as JSON lines
+
+    On failure, an error record is printed instead, so results for other
+    VMs are still listed.
+    """
+    records = []
+    try:
+        if args.get_whitelist:
+            records.append({'qube': vm.name, 'type': 'whitelist',
+                            'entries': list(appmenus.get_whitelist(vm))})
+        if args.get_default_whitelist:
+            records.append({'qube': vm.name, 'type': 'default-whitelist',
+                            'entries': appmenus.get_default_whitelist(vm)})
+        if args.get_available:
+            for available in appmenus.get_available(
+                    vm, fields=args.fields, template=args.template):
+                record = {'qube': vm.name, 'type': 'available',
+                          'file': available[0], 'name': available[1]}
+                if args.fields:
+                    record['fields'] = dict(zip(args.fields, available[2:]))
+                records.append(record)
+    except (OSError, qubesadmin.exc.QubesException) as e:
+        records = [{'qube': vm.name, 'type': 'error', 'message': str(e)}]
+    for record in records:
+        print(json.dumps(record))
+
+
 def main(args=None, app=None):
     """main function for qvm-appmenus tool"""
     args = parser.parse_args(args=args, app=app)
+    profile_format = qubesappmenus.profiling.setup(args.profile, args.app)
+    try:
+        _run(args)
+    finally:
+        if profile_format:
+            qubesappmenus.profiling.profile.report(profile_format)
+
+
+def _run(args):
+    """Perform actions requested by parsed command line *args*"""
     if args.fool:
         print('Warning: --i-understand-format-is-unstable is deprecated '
               'and has no effect.', file=sys.stderr)
     if not args.all_domains and not args.domains:
         parser.error("one of the arguments --all VMNAME is required")
-    appmenus = Appmenus()
+    if args.xdg_desktop_menu:
+        appmenus = Appmenus(
+            desktop_menu=qubesappmenus.desktopmenu.XdgDesktopMenu())
+    else:
+        appmenus = Appmenus()
     if args.source is not None:
         args.source = args.app.domains[args.source]
     if args.template is not None:
         args.template = args.app.domains[args.template]
     if args.all_domains:
         if args.remove:
+            # skip shared data like tinted icons store
             domains = [vm for vm in os.listdir(os.path.abspath(basedir))
-                       if os.path.isdir(os.path.join(basedir, vm))]
+                       if os.path.isdir(os.path.join(basedir, vm))
+                       and not vm.startswith('.')]
         else:
             domains = args.app.domains
     else:
         domains = args.domains
-    for vm in domains:
-        if str(vm) == 'dom0':
-            continue
-        # allow multiple actions
-        # for remove still use just VM name (str), because VM may be already
-        # removed.
-        if args.remove:
-            if isinstance(vm, qubesadmin.vm.QubesVM):
-                vm = vm.name
-            appmenus.appmenus_remove(vm)
-            appmenus.appicons_remove(vm)
-            try:
-                shutil.rmtree(os.path.join(basedir, str(vm)))
-            except FileNotFoundError:
-                pass
-        # for other actions - get VM object
-        if not args.remove:
+    prefetch_vms = []
+    if args.init or args.create or args.update:
+        for vm in domains:
             if not isinstance(vm, qubesadmin.vm.QubesVM):
                 try:
                     vm = args.app.domains[vm]
                 except KeyError:
-                    parser.error("'{0}' is not an existing qube".format(vm))
-            if args.init:
-                appmenus.appmenus_init(vm, src=args.source)
-            if args.get_whitelist:
-                whitelist = appmenus.get_whitelist(vm)
-                print('\n'.join(whitelist))
-            if args.set_default_whitelist:
-                whitelist = retrieve_list(args.set_default_whitelist)
-                appmenus.set_default_whitelist(vm, whitelist)
-            if args.get_default_whitelist:
-                default_whitelist = appmenus.get_default_whitelist(vm)
-                print('\n'.join(default_whitelist))
-            if args.set_whitelist:
-                whitelist = retrieve_list(args.set_whitelist)
-                appmenus.set_whitelist(vm, whitelist)
-            if args.create:
-                appmenus.appicons_create(vm, force=args.force)
-                appmenus.appmenus_create(vm)
-            if args.update:
-                appmenus.appmenus_update(vm, force=args.force)
-            if args.get_available:
-                if not args.fields:
-                    sys.stdout.write(''.join('{} - {}\n'.format(*available)
-                                             for available in
-                                             appmenus.get_available(vm)))
-                else:
-                    for result in appmenus.get_available(
-                            vm, fields=args.fields, template=args.template):
-                        print('|'.join(result))
+                    # reported below
+                    continue
+            if vm.name != 'dom0':
+                prefetch_vms.append(vm)
+    to_create = []
+    to_update = []
+    # template directories are listed only once for all VMs
+    with contextlib.closing(appmenus), appmenus.template_index(), \
+            qubesappmenus.atomicfile.sync_batch(), \
+            contextlib.ExitStack() as stack:
+        if prefetch_vms:
+            # read properties in bulk, and each feature only once
+            with qubesappmenus.profiling.profile.phase('prefetch'):
+                stack.enter_context(qubesappmenus.snapshot.prefetch(
+                    args.app, prefetch_vms, children=args.update))
+        for vm in domains:
+            if str(vm) == 'dom0':
+                continue
+            # allow multiple actions
+            # for remove still use just VM name (str), because VM may be
+            # already removed.
+            if args.remove:
+                if isinstance(vm, qubesadmin.vm.QubesVM):
+                    vm = vm.name
+                appmenus.appmenus_purge(vm)
+            # for other actions - get VM object
+            if not args.remove:
+                if not isinstance(vm, qubesadmin.vm.QubesVM):
+                    try:
+                        vm = args.app.domains[vm]
+                    except KeyError:
+                        parser.error(
+                            "'{0}' is not an existing qube".format(vm))
+                if args.init:
+                    appmenus.appmenus_init(vm, src=args.source)
+                if args.get_whitelist and not args.json:
+                    whitelist = appmenus.get_whitelist(vm)
+                    print('\n'.join(whitelist))
+                if args.set_default_whitelist:
+                    whitelist = retrieve_list(args.set_default_whitelist)
+                    appmenus.set_default_whitelist(vm, whitelist)
+                if args.get_default_whitelist and not args.json:
+                    default_whitelist = appmenus.get_default_whitelist(vm)
+                    print('\n'.join(default_whitelist))
+                if args.set_whitelist:
+                    whitelist = retrieve_list(args.set_whitelist)
+                    appmenus.set_whitelist(vm, whitelist)
+                if args.create and args.jobs > 1:
+                    # processed together after the loop
+                    to_create.append(vm)
+                elif args.create:
+                    appmenus.appicons_create(vm, force=args.force)
+                    appmenus.appmenus_create(vm)
+                if args.update:
+                    # processed together after the loop
+                    to_update.append(vm)
+                if args.get_available and not args.json:
+                    if not args.fields:
+                        sys.stdout.write(''.join('{} - {}\n'.format(*available)
+                                                 for available in
+                                                 appmenus.get_available(vm)))
+                    else:
+                        for result in appmenus.get_available(
+                                vm, fields=args.fields,
+                                template=args.template):
+                            print('|'.join(result))
+                if args.json:
+                    print_json_records(appmenus, vm, args)
+        if to_create:
+            appmenus.appmenus_create_batch(to_create, force=args.force,
+                                           jobs=args.jobs)
+        if to_update:
+            appmenus.appmenus_update_batch(to_update, force=args.force,
+                                           jobs=args.jobs)
 
 
 if __name__ == '__main__':
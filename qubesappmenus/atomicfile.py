@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+'''Replace generated files atomically
+
+Files are written to a temporary file (a hidden ``.<name>.<pid>.tmp`` in the
+same directory) and renamed over the target, so readers see either the old
+or the new content, never a truncated file. The content is fsync-ed before
+the rename, and the directory after it to make the rename durable - within
+:py:func:`sync_batch` only once per directory, at the end of the batch.
+'''
+
+import contextlib
+import os
+import threading
+
+_state = threading.local()
+
+
+def fsync_dir(dirname):
+    """Make changes of *dirname* entries durable"""
+    fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_file(path, data):
+    """Atomically replace *path* content with *data* (str)"""
+    dirname, basename = os.path.split(path)
+    dirname = dirname or '.'
+    tmp_path = os.path.join(dirname,
+                            '.{}.{}.tmp'.format(basename, os.getpid()))
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as tmp_f:
+            tmp_f.write(data)
+            tmp_f.flush()
+            os.fsync(tmp_f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
+    dirs = getattr(_state, 'dirs', None)
+    if dirs is None:
+        fsync_dir(dirname)
+    else:
+        dirs.add(dirname)
+
+
+@contextlib.contextmanager
+def sync_batch():
+    """Within this context, fsync each directory with files written by
+    :py:func:`write_file` only once, at the end"""
+    if getattr(_state, 'dirs', None) is not None:
+        # already in a batch
+        yield
+        return
+    _state.dirs = set()
+    try:
+        yield
+    finally:
+        dirs = _state.dirs
+        _state.dirs = None
+        for dirname in sorted(dirs):
+            with contextlib.suppress(FileNotFoundError):
+                fsync_dir(dirname)
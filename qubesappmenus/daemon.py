@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+'''Long-running service updating appmenus on request
+
+The service listens on a Unix socket (in ``$XDG_RUNTIME_DIR``, or passed by
+systemd socket activation) and handles requests sent by
+``qubes.UpdateAppMenusFor`` and ``qubes.RemoveAppMenusFor`` services. The
+protocol is a single request line, ``<action> <vmname> [<vmname>...]\\n``,
+where action is either ``update`` or ``remove``, answered with ``ok\\n`` or
+``error <message>\\n`` once the request is processed for all listed VMs.
+Updates queued together are processed as one batch, with a single desktop
+cache refresh. Icons not already tinted for another VM are tinted later, when
+no requests are waiting (see :py:attr:`qubesappmenus.Appmenus.lazy_icons`),
+also those left by a previous instance of the service.
+'''
+
+import asyncio
+import logging
+import os
+import re
+import socket
+
+import qubesadmin.tools
+import qubesappmenus
+
+parser = qubesadmin.tools.QubesArgumentParser(
+    show_forceroot=True,
+    description='serve appmenus update requests')
+
+parser.add_argument('--socket', action='store', default=None,
+    help='Path of the socket to listen on, by default '
+         '$XDG_RUNTIME_DIR/qubes-appmenus.sock; ignored when the socket is '
+         'passed by systemd')
+
+# limits
+request_line_size = 65536
+
+vm_name_re = re.compile(r'\A[a-zA-Z][a-zA-Z0-9_.-]*\Z')
+
+SD_LISTEN_FDS_START = 3
+
+
+def socket_path():
+    '''Default path of the service socket'''
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or \
+        '/run/user/{}'.format(os.getuid())
+    return os.path.join(runtime_dir, 'qubes-appmenus.sock')
+
+
+def systemd_socket():
+    '''Return socket passed by systemd socket activation, if any'''
+    if os.environ.get('LISTEN_PID') != str(os.getpid()):
+        return None
+    if os.environ.get('LISTEN_FDS') != '1':
+        return None
+    return socket.socket(fileno=SD_LISTEN_FDS_START)
+
+
+class AppmenusDaemon(object):
+    """Process appmenus requests one at a time, coalescing requests for the
+    same VM that are still waiting in the queue"""
+
+    #: seconds without requests before tinting icons left by updates
+    idle_delay = 2.0
+
+    def __init__(self, app, appmenus=None):
+        """
+        :param app: qubesadmin.Qubes instance, kept for the whole lifetime
+        :param appmenus: Appmenus instance
+        """
+        self.app = app
+        if appmenus is None:
+            appmenus = qubesappmenus.Appmenus(lazy_icons=True)
+        self.appmenus = appmenus
+        self.log = logging.getLogger('qubesappmenus.daemon')
+        #: (action, vm name) -> future of a queued (not yet started) request
+        self.pending = {}
+        self.queue = asyncio.Queue()
+
+    def schedule(self, action, vm_name):
+        """Queue a request, or join an identical one still in the queue
+
+        :return: future completed when the request is processed
+        """
+        key = (action, vm_name)
+        if key in self.pending:
+            self.log.debug('Coalescing %s request for %s', action, vm_name)
+            return self.pending[key]
+        future = asyncio.get_event_loop().create_future()
+        self.pending[key] = future
+        self.queue.put_nowait(key)
+        return future
+
+    def _process_updates(self, vm_names, results):
+        """Update menus of *vm_names* as one batch, storing failures in
+        *results*"""
+        # do not use cached list, the VM may be just created
+        self.app.domains.clear_cache()
+        vms = []
+        for vm_name in vm_names:
+            try:
+                vms.append(self.app.domains[vm_name])
+            except KeyError as e:
+                results[('update', vm_name)] = e
+        try:
+            self.appmenus.appmenus_update_batch(vms, force=True)
+        except Exception as e:  # pylint: disable=broad-except
+            for vm in vms:
+                results[('update', vm.name)] = e
+
+    def process_batch(self, keys):
+        """Handle queued requests (blocking)
+
+        Consecutive updates are processed as a single batch.
+
+        :param keys: list of (action, vm name) tuples, in queue order
+        :return: dict of (action, vm name) -> exception for failed requests
+        """
+        results = {}
+        vm_names = []
+        for action, vm_name in keys:
+            if action == 'update':
+                vm_names.append(vm_name)
+                continue
+            if vm_names:
+                self._process_updates(vm_names, results)
+                vm_names = []
+            try:
+                self.appmenus.appmenus_purge(vm_name)
+            except Exception as e:  # pylint: disable=broad-except
+                results[(action, vm_name)] = e
+        if vm_names:
+            self._process_updates(vm_names, results)
+        return results
+
+    def materialize_icons(self):
+        """Tint icons left by lazy updates of a single VM (blocking)"""
+        vm_name = min(self.appmenus.pending_icons)
+        self.appmenus.pending_icons.discard(vm_name)
+        try:
+            vm = self.app.domains[vm_name]
+            self.appmenus.appicons_create(vm, lazy=False)
+        except Exception as e:  # pylint: disable=broad-except
+            self.log.error('Failed to create icons for %s: %s',
+                           vm_name, str(e))
+
+    async def worker(self):
+        """Process queued requests, and tint pending icons when idle"""
+        loop = asyncio.get_event_loop()
+        while True:
+            if self.appmenus.pending_icons:
+                try:
+                    key = await asyncio.wait_for(self.queue.get(),
+                                                 self.idle_delay)
+                except asyncio.TimeoutError:
+                    await loop.run_in_executor(None, self.materialize_icons)
+                    continue
+                keys = [key]
+            else:
+                keys = [await self.queue.get()]
+            while not self.queue.empty():
+                keys.append(self.queue.get_nowait())
+            # requests arriving from now on need a new run
+            futures = [self.pending.pop(key) for key in keys]
+            results = await loop.run_in_executor(
+                None, self.process_batch, keys)
+            for key, future in zip(keys, futures):
+                if key in results:
+                    self.log.error('Failed to %s appmenus for %s: %s',
+                                   key[0], key[1], str(results[key]))
+                    future.set_exception(results[key])
+                else:
+                    future.set_result(None)
+
+    async def handle_client(self, reader, writer):
+        """Handle a single client connection"""
+        try:
+            untrusted_line = await reader.readline()
+            if len(untrusted_line) > request_line_size or \
+                    not untrusted_line.endswith(b'\n'):
+                raise ValueError('Invalid request')
+            untrusted_action, *untrusted_vm_names = \
+                untrusted_line.decode('ascii').split()
+            if untrusted_action not in ('update', 'remove'):
+                raise ValueError('Invalid action')
+            if not untrusted_vm_names:
+                raise ValueError('Missing VM name')
+            for untrusted_vm_name in untrusted_vm_names:
+                if not vm_name_re.match(untrusted_vm_name):
+                    raise ValueError('Invalid VM name')
+            action = untrusted_action
+            vm_names = untrusted_vm_names
+            results = await asyncio.shield(asyncio.gather(
+                *(self.schedule(action, vm_name) for vm_name in vm_names),
+                return_exceptions=True))
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        except Exception as e:  # pylint: disable=broad-except
+            writer.write('error {!s}\n'.format(e).encode('ascii', 'replace'))
+        else:
+            writer.write(b'ok\n')
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def serve(self, sock=None, path=None):
+        """Serve requests on given socket, or a new one bound to *path*"""
+        # icons left to tint by a previous instance
+        self.appmenus.load_pending_icons()
+        worker = asyncio.ensure_future(self.worker())
+        if sock is not None:
+            server = await asyncio.start_unix_server(
+                self.handle_client, sock=sock)
+        else:
+            if path is None:
+                path = socket_path()
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            old_umask = os.umask(0o077)
+            try:
+                server = await asyncio.start_unix_server(
+                    self.handle_client, path=path)
+            finally:
+                os.umask(old_umask)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            worker.cancel()
+
+
+def main(args=None):
+    '''Main function of qvm-appmenus-daemon tool'''
+    args = parser.parse_args(args)
+    daemon = AppmenusDaemon(args.app)
+    try:
+        asyncio.run(daemon.serve(sock=systemd_socket(), path=args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.appmenus.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+'''Register .desktop and .directory files in the desktop menu'''
+
+import os
+import re
+import shutil
+import subprocess
+
+import xdg.BaseDirectory
+
+import qubesappmenus.profiling
+
+filename_rx = re.compile(r'<Filename>([^<]*)')
+
+
+class XdgDesktopMenu(object):
+    """Register menu entries by calling the xdg-desktop-menu tool"""
+
+    @staticmethod
+    def _call(action, files, refresh_cache):
+        """Run xdg-desktop-menu *action* on *files*"""
+        desktop_menu_cmd = ['xdg-desktop-menu', action]
+        if not refresh_cache:
+            desktop_menu_cmd.append('--noupdate')
+        desktop_menu_cmd.extend(files)
+        desktop_menu_env = os.environ.copy()
+        desktop_menu_env['LC_COLLATE'] = 'C'
+        with qubesappmenus.profiling.profile.phase(
+                'subprocess:xdg-desktop-menu'):
+            subprocess.check_call(desktop_menu_cmd, env=desktop_menu_env)
+
+    def install(self, files, refresh_cache=True):
+        """Install *files* (.directory files first, then .desktop files)"""
+        self._call('install', files, refresh_cache)
+
+    def uninstall(self, files, refresh_cache=True):
+        """Uninstall *files* (.directory files first, then .desktop files)"""
+        self._call('uninstall', files, refresh_cache)
+
+    @staticmethod
+    def forceupdate():
+        """Refresh desktop database"""
+        with qubesappmenus.profiling.profile.phase(
+                'subprocess:xdg-desktop-menu'):
+            subprocess.call(['xdg-desktop-menu', 'forceupdate'])
+
+
+class NativeDesktopMenu(object):
+    """In-process equivalent of ``xdg-desktop-menu`` in user mode
+
+    Writes the same files as ``xdg-desktop-menu`` does for a non-root user:
+    copies of .desktop files in ``$XDG_DATA_HOME/applications``, copies of
+    .directory files in ``$XDG_DATA_HOME/desktop-directories`` and the menu
+    fragment in ``$XDG_CONFIG_HOME/menus/applications-merged``.
+    """
+
+    @staticmethod
+    def applications_dir():
+        """Directory for installed .desktop files"""
+        return os.path.join(xdg.BaseDirectory.xdg_data_home, 'applications')
+
+    @staticmethod
+    def directories_dir():
+        """Directory for installed .directory files"""
+        return os.path.join(xdg.BaseDirectory.xdg_data_home,
+                            'desktop-directories')
+
+    @staticmethod
+    def merged_menus_dir():
+        """Directory for .menu fragments"""
+        return os.path.join(xdg.BaseDirectory.xdg_config_home,
+                            'menus', 'applications-merged')
+
+    @staticmethod
+    def _split_files(files):
+        """Split *files* into .directory and .desktop lists, checking the
+        same ordering constraint as xdg-desktop-menu"""
+        directory_files = []
+        desktop_files = []
+        for path in files:
+            if path.endswith('.directory'):
+                if desktop_files:
+                    raise ValueError(
+                        "'{}' must precede any *.desktop file".format(path))
+                directory_files.append(path)
+            elif path.endswith('.desktop'):
+                desktop_files.append(path)
+            else:
+                raise ValueError(
+                    "'{}' is neither a .desktop nor a .directory "
+                    "file".format(path))
+        return directory_files, desktop_files
+
+    def menu_path(self, directory_files):
+        """Path of the .menu fragment for given (nested) directory files"""
+        menu_name = '-'.join(
+            os.path.basename(path)[:-len('.directory')]
+            for path in directory_files)
+        return os.path.join(self.merged_menus_dir(),
+                            'user-' + menu_name + '.menu')
+
+    @staticmethod
+    def _read_menu_entries(menu_path):
+        """Desktop files included by .menu fragment *menu_path*"""
+        try:
+            with open(menu_path, encoding='utf-8') as menu_f:
+                return filename_rx.findall(menu_f.read())
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def format_menu(directory_files, entries):
+        """Format .menu fragment the same way as xdg-desktop-menu does
+
+        Like ``sort -u`` with ``LC_COLLATE=C`` used by xdg-desktop-menu,
+        entries are deduplicated and sorted by code point (the same as
+        byte order of UTF-8). Directory files are kept in the given order,
+        as they describe nested menus.
+        """
+        lines = [
+            '<!DOCTYPE Menu PUBLIC "-//freedesktop//DTD Menu 1.0//EN"',
+            '    "http://www.freedesktop.org/standards/menu-spec/'
+            'menu-1.0.dtd">',
+            '<!-- Do not edit manually - generated and managed by '
+            'xdg-desktop-menu -->',
+            '<Menu>',
+            '    <Name>Applications</Name>',
+        ]
+        for path in directory_files:
+            basefile = os.path.basename(path)
+            lines.append('<Menu>')
+            lines.append('    <Name>{}</Name>'.format(basefile.split('.')[0]))
+            lines.append('    <Directory>{}</Directory>'.format(basefile))
+        lines.append('    <Include>')
+        for entry in sorted(set(entries)):
+            lines.append('        <Filename>{}</Filename>'.format(entry))
+        lines.append('    </Include>')
+        lines.extend('</Menu>' for _ in directory_files)
+        lines.append('</Menu>')
+        return ''.join(line + '\n' for line in lines)
+
+    def _update_menu(self, directory_files, entries):
+        """Write .menu fragment including *entries*, or remove it if there
+        are none"""
+        menu_path = self.menu_path(directory_files)
+        if not entries:
+            try:
+                os.unlink(menu_path)
+            except FileNotFoundError:
+                pass
+            return
+        os.makedirs(os.path.dirname(menu_path), exist_ok=True)
+        with open(menu_path, 'w', encoding='utf-8') as menu_f:
+            menu_f.write(self.format_menu(directory_files, entries))
+
+    def install(self, files, refresh_cache=True):
+        """Install *files* (.directory files first, then .desktop files)"""
+        directory_files, desktop_files = self._split_files(files)
+
+        if directory_files:
+            os.makedirs(self.directories_dir(), exist_ok=True)
+        for path in directory_files:
+            shutil.copy(path, self.directories_dir())
+        if desktop_files:
+            os.makedirs(self.applications_dir(), exist_ok=True)
+        for path in desktop_files:
+            shutil.copy(path, self.applications_dir())
+
+        if directory_files:
+            entries = self._read_menu_entries(
+                self.menu_path(directory_files))
+            for path in desktop_files:
+                basefile = os.path.basename(path)
+                if basefile not in entries:
+                    entries.append(basefile)
+            self._update_menu(directory_files, entries)
+
+        if refresh_cache:
+            self.forceupdate()
+
+    def uninstall(self, files, refresh_cache=True):
+        """Uninstall *files* (.directory files first, then .desktop files)"""
+        directory_files, desktop_files = self._split_files(files)
+
+        removed = set(os.path.basename(path) for path in desktop_files)
+        if directory_files:
+            entries = [entry for entry in self._read_menu_entries(
+                self.menu_path(directory_files)) if entry not in removed]
+            self._update_menu(directory_files, entries)
+
+        for basefile in removed:
+            try:
+                os.unlink(os.path.join(self.applications_dir(), basefile))
+            except FileNotFoundError:
+                pass
+        for path in directory_files:
+            try:
+                os.unlink(os.path.join(self.directories_dir(),
+                                       os.path.basename(path)))
+            except FileNotFoundError:
+                pass
+
+        if refresh_cache:
+            self.forceupdate()
+
+    @staticmethod
+    def forceupdate():
+        """Refresh desktop database
+
+        xdg-desktop-menu updates the desktop database only in system mode,
+        so there is nothing to do for user menus.
+        """
+
+
+def default_desktop_menu():
+    """Choose menu backend for the current user
+
+    The native backend implements only the user mode of xdg-desktop-menu,
+    so running as root falls back to the external tool.
+    """
+    if os.getuid() == 0:
+        return XdgDesktopMenu()
+    return NativeDesktopMenu()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+'''Precompiled .desktop and .directory templates'''
+
+#: placeholders, in the order they are substituted
+PLACEHOLDERS = ('%VMNAME%', '%VMDIR%', '%XDGICON%')
+
+
+def compile_template(source):
+    """Split *source* into literal strings and placeholder slots
+
+    :return: tuple of str (literal text) and int (index in
+    :py:data:`PLACEHOLDERS`) items
+    """
+    segments = [source]
+    for slot, placeholder in enumerate(PLACEHOLDERS):
+        split_segments = []
+        for segment in segments:
+            if isinstance(segment, int):
+                split_segments.append(segment)
+                continue
+            for i, part in enumerate(segment.split(placeholder)):
+                if i:
+                    split_segments.append(slot)
+                split_segments.append(part)
+        segments = split_segments
+    return tuple(segment for segment in segments if segment != '')
+
+
+class DesktopTemplate(object):
+    """Template compiled for rendering both normal and DispVM entries"""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, source):
+        self.normal = compile_template(source)
+        if '\nX-Qubes-DispvmExec=' not in source and '\nExec=' in source:
+            #: None if the entry cannot be started in a DispVM
+            self.dispvm = None
+        else:
+            self.dispvm = compile_template(source.
+                replace('\nExec=', '\nX-Qubes-NonDispvmExec=').
+                replace('\nX-Qubes-DispvmExec=', '\nExec=').
+                replace('\nName=%VMNAME%', '\nName=%VMNAME% (dvm)'))
+        #: whether %XDGICON% needs to be known to render the template
+        self.uses_icon = any(
+            segment == PLACEHOLDERS.index('%XDGICON%')
+            for segment in self.normal + (self.dispvm or ()))
+
+    def render(self, values, dispvm=False):
+        """Fill placeholders with *values* (in :py:data:`PLACEHOLDERS`
+        order)
+
+        :raise ValueError: DispVM variant requested, but not supported
+        """
+        segments = self.dispvm if dispvm else self.normal
+        if segments is None:
+            raise ValueError('DispVM not supported by this template')
+        return ''.join(values[segment] if isinstance(segment, int)
+                       else segment for segment in segments)
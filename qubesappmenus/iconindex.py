@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+'''Persistent index of icons content, to skip unchanged icons'''
+
+import hashlib
+
+import qubesappmenus.jsonindex
+
+
+def image_hash(image):
+    """Content hash of a :py:class:`qubesimgconverter.Image`"""
+    digest = hashlib.sha256()
+    digest.update('{0} {1}\n'.format(image.width, image.height).encode())
+    digest.update(image.data)
+    return digest.hexdigest()
+
+
+class IconIndex(qubesappmenus.jsonindex.JsonIndex):
+    """Map of icon file name -> content metadata for a single icons directory
+
+    The index is kept next to the directory, as ``<directory>.index`` (for
+    example ``apps.tempicons.index``), so it is never mistaken for an icon.
+    Entries are plain JSON values: the :py:func:`image_hash` of template
+    icons, or the source hash and label color of tinted icons. An entry is
+    only a hint - a missing or unreadable index just means the icons are
+    processed again.
+    """
+
+    suffix = '.index'
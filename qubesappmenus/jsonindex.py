@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+'''Small JSON maps kept next to a directory, with an entry per file'''
+
+import json
+import os
+
+import qubesappmenus.atomicfile
+
+
+class JsonIndex(object):
+    """Map of file name -> JSON value for a single directory
+
+    The map is kept next to the directory, as ``<directory><suffix>``, so it
+    is never mistaken for one of its files. Subclasses define
+    :py:attr:`suffix` and the meaning of the values.
+    """
+
+    #: suffix added to the directory path to get the index path
+    suffix = None
+
+    def __init__(self, dirname, load=True):
+        """
+        :param dirname: directory the index describes
+        :param load: read the existing index, otherwise start empty
+        """
+        self.path = dirname.rstrip('/') + self.suffix
+        self.dirty = False
+        self.entries = {}
+        if not load:
+            return
+        try:
+            with open(self.path, encoding='utf-8') as index_f:
+                self.entries = json.load(index_f)
+            if not isinstance(self.entries, dict):
+                raise ValueError('invalid index')
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, name):
+        """Value recorded for file *name*, or None"""
+        return self.entries.get(name)
+
+    def set(self, name, value):
+        """Record value of file *name*"""
+        if self.entries.get(name) != value:
+            self.entries[name] = value
+            self.dirty = True
+
+    def discard(self, name):
+        """Forget file *name*"""
+        if self.entries.pop(name, None) is not None:
+            self.dirty = True
+
+    def save(self):
+        """Write the index (atomically), if it was changed"""
+        if not self.dirty:
+            return
+        qubesappmenus.atomicfile.write_file(
+            self.path, json.dumps(self.entries, sort_keys=True))
+        self.dirty = False
+
+    @classmethod
+    def remove(cls, dirname):
+        """Remove index of *dirname*"""
+        try:
+            os.unlink(dirname.rstrip('/') + cls.suffix)
+        except FileNotFoundError:
+            pass
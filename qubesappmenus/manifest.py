@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+'''Manifest of generated menu entries, to skip unchanged ones'''
+
+import hashlib
+import json
+
+import qubesappmenus.jsonindex
+
+
+def inputs_digest(inputs):
+    """Hash of JSON-serializable *inputs* a file is generated from"""
+    return hashlib.sha256(json.dumps(
+        inputs, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+class Manifest(qubesappmenus.jsonindex.JsonIndex):
+    """Map of generated file name -> :py:func:`inputs_digest` of its
+    template and values, for a single ``apps`` directory
+
+    Kept next to the directory, as ``<directory>.manifest`` (for example
+    ``apps.manifest``). When inputs of an entry are the same as recorded,
+    the file is neither rendered nor read. A missing or unreadable manifest
+    means all entries are compared with the files again.
+    """
+
+    suffix = '.manifest'
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+'''Process independent qubes in parallel threads
+
+Qubes are processed in waves: first qubes not based on any other, then
+qubes based on them and so on, so a template is always done before its
+children. Log messages emitted while processing a qube are held back and
+emitted together, in processing order, as soon as the qube and the ones
+before it are done - so the output does not depend on scheduling and is
+the same as with a single job.
+'''
+
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import logging
+import threading
+
+import qubesappmenus.atomicfile
+
+
+def template_depth(vm):
+    """Number of templates *vm* is based on, through all the levels"""
+    depth = 0
+    while hasattr(vm, 'template'):
+        vm = vm.template
+        depth += 1
+    return depth
+
+
+class QubeLogBuffer(object):
+    """Hold back log records emitted while processing a qube in a worker
+    thread, until :py:meth:`flush_qube`
+
+    Installed as a filter of the handlers, so the logging configuration
+    is left alone and records emitted by other threads pass unchanged.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        #: qube name -> list of (handler, log record)
+        self.records = collections.defaultdict(list)
+
+    @contextlib.contextmanager
+    def attached(self, handlers):
+        """Hold back records passed to *handlers* within this context"""
+        filters = [(handler, functools.partial(self.hold, handler))
+                   for handler in handlers]
+        for handler, record_filter in filters:
+            handler.addFilter(record_filter)
+        try:
+            yield
+        finally:
+            for handler, record_filter in filters:
+                handler.removeFilter(record_filter)
+
+    def hold(self, handler, record):
+        """Filter of *handler*, keeping *record* for later if emitted while
+        processing a qube"""
+        qube = getattr(self.local, 'qube', None)
+        if qube is None:
+            return True
+        self.records[qube].append((handler, record))
+        return False
+
+    def flush_qube(self, qube):
+        """Emit records held back for *qube*"""
+        for handler, record in self.records.pop(qube, []):
+            handler.handle(record)
+
+
+def process_qubes(tasks, jobs):
+    """Run tasks, up to *jobs* at a time
+
+    A failure is handled like in a serial loop over the tasks in processing
+    order: no further tasks are started, messages of qubes processed after
+    the failed one are dropped and the failure is raised once the tasks
+    already running are done.
+
+    :param tasks: list of (vm, function) tuples, function is called with
+    *vm* as the only argument; each qube should be listed only once
+    :param jobs: number of threads, with 1 tasks are run one by one in the
+    calling thread
+    :raise: the first failure, in processing order
+    """
+    waves = collections.defaultdict(list)
+    for vm, func in tasks:
+        waves[template_depth(vm)].append((vm, func))
+
+    if jobs < 2:
+        for depth in sorted(waves):
+            for vm, func in waves[depth]:
+                with qubesappmenus.atomicfile.sync_batch():
+                    func(vm)
+        return
+
+    buffer = QubeLogBuffer()
+
+    def run(vm, func):
+        buffer.local.qube = vm.name
+        try:
+            with qubesappmenus.atomicfile.sync_batch():
+                func(vm)
+        finally:
+            buffer.local.qube = None
+
+    with buffer.attached(logging.getLogger().handlers), \
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=jobs) as executor:
+        for depth in sorted(waves):
+            futures = [(vm, executor.submit(run, vm, func))
+                       for vm, func in waves[depth]]
+            for vm, future in futures:
+                try:
+                    future.result()
+                except Exception:
+                    for _, other_future in futures:
+                        other_future.cancel()
+                    raise
+                finally:
+                    buffer.flush_qube(vm.name)
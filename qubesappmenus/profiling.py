@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+'''Opt-in timing of processing phases and counting of events
+
+Instrumented code records phases and counters on the module-level
+:py:data:`profile`, which does nothing until enabled, for example with
+``qvm-appmenus --profile`` or the ``QUBES_APPMENUS_PROFILE`` environment
+variable (set to ``text`` or ``json``). The summary is printed to stderr at
+the end of the run, including a failed one.
+'''
+
+import collections
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+#: environment variable enabling the profile, if not enabled explicitly
+ENV_VAR = 'QUBES_APPMENUS_PROFILE'
+
+#: summary formats
+FORMATS = ('text', 'json')
+
+
+class Profile(object):
+    """Durations of phases and counters of events
+
+    Phases may be nested (or run in parallel threads), so their durations
+    overlap and do not sum up to the total run time.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        #: phase name -> [number of calls, total seconds]
+        self.phases = collections.defaultdict(lambda: [0, 0.0])
+        self.counters = collections.Counter()
+        self._start = None
+        self._lock = threading.Lock()
+
+    def enable(self):
+        """Start collecting data"""
+        self.enabled = True
+        self._start = time.perf_counter()
+
+    def add_phase(self, name, seconds):
+        """Record a call of phase *name* taking *seconds*"""
+        with self._lock:
+            phase = self.phases[name]
+            phase[0] += 1
+            phase[1] += seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Measure duration of the context as phase *name*"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def count(self, name, value=1):
+        """Increase counter *name*"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += value
+
+    def summary(self):
+        """Collected data, as a JSON-serializable dict"""
+        with self._lock:
+            return {
+                'total_seconds': round(time.perf_counter() - self._start, 6)
+                if self._start is not None else 0.0,
+                'phases': {name: {'calls': calls,
+                                  'seconds': round(seconds, 6)}
+                           for name, (calls, seconds)
+                           in sorted(self.phases.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def report(self, fmt='text', file=None):
+        """Print summary in format *fmt* (see :py:data:`FORMATS`)"""
+        if file is None:
+            file = sys.stderr
+        summary = self.summary()
+        if fmt == 'json':
+            print(json.dumps(summary), file=file)
+            return
+        print('total: {:.3f}s'.format(summary['total_seconds']), file=file)
+        for name, phase in summary['phases'].items():
+            print('phase {}: {:.3f}s in {} calls'.format(
+                name, phase['seconds'], phase['calls']), file=file)
+        for name, value in summary['counters'].items():
+            print('counter {}: {}'.format(name, value), file=file)
+
+
+#: profile of the current process
+profile = Profile()
+
+
+def profiled(name):
+    """Decorator measuring calls of a function as phase *name* of
+    :py:data:`profile`"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def setup(fmt=None, app=None):
+    """Enable :py:data:`profile` if *fmt* (or the environment variable)
+    asks for it, and measure admin API calls of *app*
+
+    :return: summary format, or None if profiling is not enabled
+    """
+    if fmt is None:
+        fmt = os.environ.get(ENV_VAR) or None
+        if fmt is not None and fmt not in FORMATS:
+            fmt = 'text'
+    if fmt is None:
+        return None
+    profile.enable()
+    if app is not None:
+        app.qubesd_call = profiled('admin-api')(app.qubesd_call)
+    return fmt
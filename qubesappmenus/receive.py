@@ -27,12 +27,18 @@ import re
 import os
 import sys
 import shlex
+import concurrent.futures
+import contextlib
 import importlib.resources
 import qubesimgconverter
 
 import qubesadmin.exc
 import qubesadmin.tools
 import qubesappmenus
+import qubesappmenus.atomicfile
+import qubesappmenus.iconindex
+import qubesappmenus.profiling
+import qubesappmenus.snapshot
 
 parser = qubesadmin.tools.QubesArgumentParser(
     vmname_nargs='?',
@@ -43,6 +49,17 @@ parser.add_argument('--force-rpc',
     action='store_true', default=False,
     help="Force to start a new RPC call, even if called from existing one")
 
+parser.add_argument('--icon-jobs', metavar='N', type=int,
+    default=None,
+    help='Number of icons to retrieve from the VM in parallel (default: 4)')
+
+parser.add_argument('--profile', nargs='?', const='text',
+    choices=qubesappmenus.profiling.FORMATS, default=None,
+    help='Print durations of processing phases and event counters to '
+         'stderr at the end, as text (default) or JSON; also enabled by '
+         'the {} environment variable'.format(
+             qubesappmenus.profiling.ENV_VAR))
+
 parser.add_argument('--regenerate-only',
     action='store_true', default=False,
     help='Only regenerate appmenus entries, do not synchronize with system '
@@ -58,6 +75,9 @@ required_fields = ["Name"]
 appmenus_line_size = 1024
 appmenus_line_count = 100000
 
+# default number of icons retrieved in parallel
+icon_jobs = 4
+
 # regexps for sanitization of retrieved values
 std_re = re.compile(r"\A[/a-zA-Z0-9.,:&()_ +-]*\Z")
 fields_regexp = {
@@ -121,48 +141,57 @@ def sanitise_categories(untrusted_value):
     return ';'.join(categories) + ';'
 
 
-def get_appmenus(vm):
-    '''Get appmenus from a *vm*. *vm* can be :py:obj:None to retrieve data
-    from stdin - should be a `qubes.GetAppmenus` service in the VM connected
-    to it.'''
+line_rx = re.compile(
+    r"([a-zA-Z0-9._-]+?)(?:\.desktop)?:"
+    r"([a-zA-Z0-9-]+(?:\[[a-zA-Z@_]+\])?)\s*=\s*(.*)")
+ignore_rx = re.compile(r"\A.*([a-zA-Z0-9._-]+.desktop):(#.*|\s*)\Z")
+
+
+def read_appmenus_lines(vm):
+    '''Yield lines of `qubes.GetAppmenus` service output as they arrive,
+    enforcing size and count limits. *vm* can be :py:obj:None to read from
+    stdin.'''
     appmenus_line_limit_left = appmenus_line_count
-    untrusted_appmenulist = []
     if vm is None:
         while appmenus_line_limit_left > 0:
             untrusted_line = sys.stdin.readline(appmenus_line_size)
             if not untrusted_line:
                 break
-            untrusted_appmenulist.append(untrusted_line.strip())
             appmenus_line_limit_left -= 1
+            yield untrusted_line.strip()
         if appmenus_line_limit_left == 0:
             raise qubesadmin.exc.QubesException("Line count limit exceeded")
-    else:
-        p = vm.run_service('qubes.GetAppmenus')
+        return
+
+    p = vm.run_service('qubes.GetAppmenus')
+    try:
         while appmenus_line_limit_left > 0:
             untrusted_line = p.stdout.readline(appmenus_line_size)
             if not untrusted_line:
                 break
+            appmenus_line_limit_left -= 1
             try:
                 untrusted_line = untrusted_line.decode('ascii')
-                untrusted_appmenulist.append(untrusted_line.strip())
             except UnicodeDecodeError:
                 # simply ignore non-ASCII lines
-                pass
-            appmenus_line_limit_left -= 1
-        p.wait()
+                continue
+            yield untrusted_line.strip()
+    finally:
+        # also when the consumer gave up early
         p.stdout.close()
-        if p.returncode != 0:
-            raise qubesadmin.exc.QubesException(
-                "Error getting application list")
-        if appmenus_line_limit_left == 0:
-            raise qubesadmin.exc.QubesException("Line count limit exceeded")
+        p.wait()
+    if p.returncode != 0:
+        raise qubesadmin.exc.QubesException(
+            "Error getting application list")
+    if appmenus_line_limit_left == 0:
+        raise qubesadmin.exc.QubesException("Line count limit exceeded")
+
 
+def parse_appmenus(untrusted_lines):
+    '''Sanitize lines in `qubes.GetAppmenus` format and build appmenus
+    dictionary from them, processing each line as soon as it is available.'''
     appmenus = {}
-    line_rx = re.compile(
-        r"([a-zA-Z0-9._-]+?)(?:\.desktop)?:"
-        r"([a-zA-Z0-9-]+(?:\[[a-zA-Z@_]+\])?)\s*=\s*(.*)")
-    ignore_rx = re.compile(r"\A.*([a-zA-Z0-9._-]+.desktop):(#.*|\s*)\Z")
-    for untrusted_line in untrusted_appmenulist:
+    for untrusted_line in untrusted_lines:
         # Ignore blank lines and comments
         if not untrusted_line or ignore_rx.match(untrusted_line):
             continue
@@ -203,6 +232,13 @@ def get_appmenus(vm):
     return appmenus
 
 
+def get_appmenus(vm):
+    '''Get appmenus from a *vm*. *vm* can be :py:obj:None to retrieve data
+    from stdin - should be a `qubes.GetAppmenus` service in the VM connected
+    to it.'''
+    return parse_appmenus(read_appmenus_lines(vm))
+
+
 def create_template(path, name, values, legacy):
     '''
     Create desktop entry template based on values in `values` and save it to
@@ -278,17 +314,43 @@ def create_template(path, name, values, legacy):
     except FileNotFoundError:
         existing_desktop_entry = ''
     if desktop_entry != existing_desktop_entry:
-        with open(path, "w", encoding='utf-8') as desktop_file:
-            desktop_file.write(desktop_entry)
+        qubesappmenus.atomicfile.write_file(path, desktop_entry)
+        qubesappmenus.profiling.profile.count('templates-written')
+    else:
+        qubesappmenus.profiling.profile.count('templates-unchanged')
+
 
+def retrieve_icons(vm, icon_names, executor):
+    '''Start retrieving icons *icon_names* from *vm*, with separate
+    `qubes.GetImageRGBA` calls run in *executor*.
 
-def process_appmenus_templates(appmenusext, vm, appmenus):
+    :return: dict of icon name -> :py:class:`concurrent.futures.Future`
+    '''
+    return {name: executor.submit(
+                qubesimgconverter.Image.get_xdg_icon_from_vm, vm, name)
+            for name in icon_names}
+
+
+@qubesappmenus.profiling.profiled('receive:templates')
+def process_appmenus_templates(appmenusext, vm, appmenus, jobs=None):
     '''Get parsed appmenus and write appmenus templates from them.
 
     :param appmenusext: AppmenusExtension instance
     :param vm: VM from which appmenus were extracted
     :param appmenus: appmenus dictionary, indexed with entry basename
+    :param jobs: number of icons retrieved in parallel, :py:data:`icon_jobs`
+    if None
     '''
+    if jobs is None:
+        jobs = icon_jobs
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor, \
+            qubesappmenus.atomicfile.sync_batch():
+        _process_appmenus_templates(appmenusext, vm, appmenus, executor)
+
+
+def _process_appmenus_templates(appmenusext, vm, appmenus, executor):
+    '''Body of :py:func:`process_appmenus_templates`, with icons retrieved
+    using *executor*'''
     old_umask = os.umask(0o002)
 
     legacy_appmenus = vm.features.check_with_template(
@@ -301,6 +363,7 @@ def process_appmenus_templates(appmenusext, vm, appmenus):
     template_icons_dir = appmenusext.template_icons_dirs(vm)[0]
     if not os.path.exists(template_icons_dir):
         os.makedirs(template_icons_dir)
+    icon_index = qubesappmenus.iconindex.IconIndex(template_icons_dir)
 
     # Only create Start shortcut for standalone VMs. Otherwise we will use the
     # one from template VM.
@@ -318,6 +381,15 @@ def process_appmenus_templates(appmenusext, vm, appmenus):
 
     # Do not create reserved Start entry
     appmenus.pop('qubes-start', None)
+
+    # TODO: icons support in offline mode
+    # TODO if options.offline_mode:
+    # TODO     new_appmenus[appmenu_name].pop('Icon', None)
+    # start retrieving all icons, each result is collected below
+    icon_futures = retrieve_icons(vm, sorted(set(
+        appmenu['Icon'] for appmenu in appmenus.values()
+        if 'Icon' in appmenu)), executor)
+
     for appmenu_name in appmenus.keys():
         appmenu_path = os.path.join(
             templates_dir,
@@ -327,23 +399,35 @@ def process_appmenus_templates(appmenusext, vm, appmenus):
         else:
             vm.log.info("Creating {0}".format(appmenu_name))
 
-        # TODO: icons support in offline mode
-        # TODO if options.offline_mode:
-        # TODO     new_appmenus[appmenu_name].pop('Icon', None)
         if 'Icon' in appmenus[appmenu_name]:
             # the following line is used for time comparison
             icondest = os.path.join(template_icons_dir,
                                     appmenu_name + '.png')
 
             try:
-                icon = qubesimgconverter.Image. \
-                    get_xdg_icon_from_vm(vm, appmenus[appmenu_name]['Icon'])
-                if os.path.exists(icondest):
+                with qubesappmenus.profiling.profile.phase('receive:icons'):
+                    icon = icon_futures[
+                        appmenus[appmenu_name]['Icon']].result()
+                icon_hash = qubesappmenus.iconindex.image_hash(icon)
+                icon_file = appmenu_name + '.png'
+                if not os.path.exists(icondest):
+                    icon.save(icondest)
+                    qubesappmenus.profiling.profile.count(
+                        'template-icons-written')
+                elif icon_hash != icon_index.get(icon_file):
                     old_icon = qubesimgconverter.Image.load_from_file(icondest)
+                    if icon != old_icon:
+                        icon.save(icondest)
+                        qubesappmenus.profiling.profile.count(
+                            'template-icons-written')
+                    else:
+                        qubesappmenus.profiling.profile.count(
+                            'template-icons-unchanged')
                 else:
-                    old_icon = None
-                if old_icon is None or icon != old_icon:
-                    icon.save(icondest)
+                    # the same icon is already saved
+                    qubesappmenus.profiling.profile.count(
+                        'template-icons-unchanged')
+                icon_index.set(icon_file, icon_hash)
             except Exception as e:  # pylint: disable=broad-except
                 vm.log.warning('Failed to get icon for {0}: {1!s}'.
                     format(appmenu_name, e))
@@ -356,6 +440,8 @@ def process_appmenus_templates(appmenusext, vm, appmenus):
         create_template(appmenu_path, appmenu_name,
             appmenus[appmenu_name], legacy_appmenus)
 
+    icon_index.save()
+
     # Delete appmenus of removed applications
     for appmenu_file in os.listdir(templates_dir):
         if not appmenu_file.endswith('.desktop'):
@@ -373,6 +459,7 @@ def process_appmenus_templates(appmenusext, vm, appmenus):
     os.umask(old_umask)
 
 
+@qubesappmenus.profiling.profiled('receive:appmenus')
 def retrieve_appmenus_templates(vm, use_stdin=True):
     '''Retrieve appmenus from the VM. If not running in offline mode,
     additionally retrieve application icons and store them into
@@ -394,29 +481,42 @@ def main(args=None):
     env_vmname = os.environ.get("QREXEC_REMOTE_DOMAIN")
 
     args = parser.parse_args(args)
+    profile_format = qubesappmenus.profiling.setup(args.profile, args.app)
 
-    if env_vmname:
-        vm = args.app.domains[env_vmname]
-    elif not args.domains:
-        parser.error("You must specify at least the VM name!")
-        # pylint doesn't know parser.error doesn't return
-        assert False
-    else:
-        vm = args.domains[0]
-
-    if env_vmname is None or args.force_rpc:
-        use_stdin = False
-    else:
-        use_stdin = True
-    appmenusext = qubesappmenus.Appmenus()
-    if not args.regenerate_only:
-        try:
-            new_appmenus = retrieve_appmenus_templates(vm, use_stdin=use_stdin)
-        except qubesadmin.exc.QubesVMNotRunningError as e:
-            parser.error(str(e))
-
-        if not new_appmenus and vm.klass != "AppVM":
-            vm.log.info("No appmenus received, terminating")
+    try:
+        if env_vmname:
+            vm = args.app.domains[env_vmname]
+        elif not args.domains:
+            parser.error("You must specify at least the VM name!")
+            # pylint doesn't know parser.error doesn't return
+            assert False
         else:
-            process_appmenus_templates(appmenusext, vm, new_appmenus)
-    appmenusext.appmenus_update(vm)
+            vm = args.domains[0]
+
+        with contextlib.ExitStack() as stack:
+            with qubesappmenus.profiling.profile.phase('prefetch'):
+                stack.enter_context(
+                    qubesappmenus.snapshot.prefetch(args.app, [vm]))
+
+            if env_vmname is None or args.force_rpc:
+                use_stdin = False
+            else:
+                use_stdin = True
+            appmenusext = stack.enter_context(
+                contextlib.closing(qubesappmenus.Appmenus()))
+            if not args.regenerate_only:
+                try:
+                    new_appmenus = retrieve_appmenus_templates(
+                        vm, use_stdin=use_stdin)
+                except qubesadmin.exc.QubesVMNotRunningError as e:
+                    parser.error(str(e))
+
+                if not new_appmenus and vm.klass != "AppVM":
+                    vm.log.info("No appmenus received, terminating")
+                else:
+                    process_appmenus_templates(appmenusext, vm, new_appmenus,
+                                               jobs=args.icon_jobs)
+            appmenusext.appmenus_update(vm)
+    finally:
+        if profile_format:
+            qubesappmenus.profiling.profile.report(profile_format)
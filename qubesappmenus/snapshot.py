@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+'''Snapshot of qube properties and features for a single run'''
+
+import contextlib
+
+import qubesadmin.exc
+
+#: properties of the target qubes used during menu generation
+PROPERTIES = ('klass', 'label', 'icon', 'template', 'template_for_dispvms',
+              'provides_network', 'auto_cleanup', 'guivm')
+
+_MISSING = object()
+
+
+class FeaturesSnapshot(object):
+    """Features of a qube, each retrieved at most once
+
+    Wraps :py:class:`qubesadmin.features.Features`; changes are passed
+    through and invalidate the remembered values.
+    """
+
+    def __init__(self, features):
+        self.features = features
+        self._values = {}
+        self._checked = {}
+
+    def get(self, feature, default=None):
+        """Value of *feature*, or *default* if not set"""
+        try:
+            value = self._values[feature]
+        except KeyError:
+            value = self.features.get(feature, _MISSING)
+            self._values[feature] = value
+        return default if value is _MISSING else value
+
+    def check_with_template(self, feature, default=None):
+        """Value of *feature* of the qube or its template"""
+        try:
+            value = self._checked[feature]
+        except KeyError:
+            value = self.features.check_with_template(feature, _MISSING)
+            self._checked[feature] = value
+        return default if value is _MISSING else value
+
+    def __getitem__(self, feature):
+        value = self.get(feature, _MISSING)
+        if value is _MISSING:
+            raise KeyError(feature)
+        return value
+
+    def __contains__(self, feature):
+        return self.get(feature, _MISSING) is not _MISSING
+
+    def __setitem__(self, feature, value):
+        self._invalidate()
+        self.features[feature] = value
+
+    def __delitem__(self, feature):
+        self._invalidate()
+        del self.features[feature]
+
+    def __iter__(self):
+        return iter(self.features)
+
+    def _invalidate(self):
+        """Forget remembered values, after a change"""
+        # values of other qubes features may depend on this one, but within
+        # a single run only queues of GUI VMs are modified
+        self._values.clear()
+        self._checked.clear()
+
+
+@contextlib.contextmanager
+def prefetch(app, vms, children=False):
+    """Read properties of *vms* and their templates in bulk, and remember
+    their features within this context
+
+    With property cache of qubesadmin enabled, all properties of a qube
+    are retrieved with a single ``admin.vm.property.GetAll`` call and later
+    reads are served from the cache. Features have no bulk call, so each
+    of them is retrieved at most once, on first use. Clients without the
+    property cache would only make more calls, so nothing is done for them.
+    On exit, the original features objects and cache setting are restored,
+    so a long-running process does not keep stale values.
+
+    :param children: include qubes based on *vms*
+    """
+    if not hasattr(app, 'cache_enabled'):
+        yield
+        return
+    cache_enabled = app.cache_enabled
+    app.cache_enabled = True
+    #: list of (vm, original features)
+    wrapped = []
+    try:
+        seen = set()
+        vms = list(vms)
+        if children:
+            for vm in list(vms):
+                try:
+                    vms.extend(vm.appvms)
+                except (AttributeError, qubesadmin.exc.QubesException):
+                    pass
+        while vms:
+            vm = vms.pop()
+            if vm.name in seen:
+                continue
+            seen.add(vm.name)
+            for prop in PROPERTIES:
+                try:
+                    getattr(vm, prop)
+                except (AttributeError, qubesadmin.exc.QubesException):
+                    pass
+            if not isinstance(vm.features, FeaturesSnapshot):
+                wrapped.append((vm, vm.features))
+                # bypass remote properties handling of qubesadmin objects
+                object.__setattr__(vm, 'features',
+                                   FeaturesSnapshot(vm.features))
+            try:
+                vms.append(vm.template)
+            except (AttributeError, qubesadmin.exc.QubesException):
+                pass
+        yield
+    finally:
+        for vm, features in wrapped:
+            object.__setattr__(vm, 'features', features)
+        app.cache_enabled = cache_enabled
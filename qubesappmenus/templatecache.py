@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+'''Cache of parsed .desktop templates'''
+
+import os
+
+import qubesappmenus.jsonindex
+
+NAME_PREFIX = 'Name=%VMNAME%: '
+
+
+def parse_template(path):
+    """Parse [Desktop Entry] section of .desktop template *path*
+
+    :return: tuple of (list of names from ``Name=%VMNAME%: ...`` lines,
+    dict of all keys -> values, the last one for repeated keys)
+    """
+    names = []
+    values = {}
+    with open(path, encoding='utf-8') as file:
+        main_section = False
+        for line in file:
+            if line.startswith('['):
+                main_section = line == '[Desktop Entry]\n'
+                continue
+            if not main_section:
+                continue
+            if '=' not in line:
+                continue
+            if line.startswith(NAME_PREFIX):
+                names.append(line.partition(NAME_PREFIX)[2].strip())
+            [field_name, value] = [x.strip() for x in line.split('=', 1)]
+            values[field_name] = value
+    return names, values
+
+
+class ParsedTemplates(qubesappmenus.jsonindex.JsonIndex):
+    """Map of template file name -> [mtime_ns, size, names, values], see
+    :py:func:`parse_template`"""
+
+    suffix = '.index'
+
+
+class TemplateCache(object):
+    """Parsed templates, reused as long as file mtime and size are the same
+
+    When *persistent*, parsed templates of a directory are also stored as
+    ``<directory>.index`` (for example ``apps.templates.index``) and loaded
+    by later runs. Failures to read or write it are ignored.
+    """
+
+    def __init__(self, persistent=True):
+        self.persistent = persistent
+        #: directory -> ParsedTemplates
+        self._dirs = {}
+
+    def _index(self, dirname):
+        """Cached entries of directory *dirname*, loaded from its persistent
+        index if enabled"""
+        try:
+            return self._dirs[dirname]
+        except KeyError:
+            pass
+        index = ParsedTemplates(dirname, load=self.persistent)
+        self._dirs[dirname] = index
+        return index
+
+    def get(self, path):
+        """Parsed template *path*, see :py:func:`parse_template`"""
+        dirname, filename = os.path.split(path)
+        stat = os.stat(path)
+        index = self._index(dirname)
+        entry = index.get(filename)
+        if not isinstance(entry, list) or len(entry) != 4 or \
+                entry[:2] != [stat.st_mtime_ns, stat.st_size]:
+            names, values = parse_template(path)
+            entry = [stat.st_mtime_ns, stat.st_size, names, values]
+            index.set(filename, entry)
+        return entry[2], entry[3]
+
+    def save(self):
+        """Write indexes of directories with newly parsed templates,
+        dropping templates that no longer exist"""
+        for dirname, index in self._dirs.items():
+            if not index.dirty:
+                continue
+            if not self.persistent:
+                index.dirty = False
+                continue
+            try:
+                existing = set(os.listdir(dirname))
+                for filename in set(index.entries) - existing:
+                    index.discard(filename)
+                index.save()
+            except OSError:
+                pass
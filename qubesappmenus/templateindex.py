@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+'''Cache of template chains and template directories for a single run'''
+
+import os
+
+import qubesappmenus.iconindex
+
+
+class TemplateIndex(object):
+    """Remember template chain of each VM and content of each template
+    directory, so they are looked up only once
+
+    Meant to live only as long as template directories are not modified -
+    see :py:meth:`qubesappmenus.Appmenus.template_index`.
+    """
+
+    def __init__(self):
+        #: VM name -> list of names of the VM and its templates
+        self._chains = {}
+        #: directory path -> (list of file names, set of file names), or
+        #: None if the directory does not exist
+        self._listings = {}
+        #: directory path -> IconIndex
+        self._icon_indexes = {}
+
+    def template_chain(self, vm):
+        """Names of *vm* and its templates, closest first"""
+        try:
+            return self._chains[vm.name]
+        except KeyError:
+            pass
+        chain = [vm.name]
+        if hasattr(vm, 'template'):
+            chain.extend(self.template_chain(vm.template))
+        self._chains[vm.name] = chain
+        return chain
+
+    def _listing(self, path):
+        """Names in directory *path* as (list, set), or None if it does not
+        exist, cached"""
+        try:
+            return self._listings[path]
+        except KeyError:
+            pass
+        try:
+            names = os.listdir(path)
+            listing = (names, set(names))
+        except (FileNotFoundError, NotADirectoryError):
+            listing = None
+        self._listings[path] = listing
+        return listing
+
+    def listdir(self, path):
+        """File names in directory *path*, or None if it does not exist"""
+        listing = self._listing(path)
+        if listing is None:
+            return None
+        return listing[0]
+
+    def contains(self, path, name):
+        """Check if directory *path* contains file *name*"""
+        listing = self._listing(path)
+        return listing is not None and name in listing[1]
+
+    def icon_index(self, path):
+        """:py:class:`qubesappmenus.iconindex.IconIndex` of template icons
+        directory *path*, not to be modified"""
+        try:
+            return self._icon_indexes[path]
+        except KeyError:
+            pass
+        index = qubesappmenus.iconindex.IconIndex(path)
+        self._icon_indexes[path] = index
+        return index
+
+    def invalidate(self):
+        """Forget directories content, after they were modified"""
+        self._listings.clear()
+        self._icon_indexes.clear()
@@ -22,10 +22,15 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
+import asyncio
+import concurrent.futures
 import io
+import json
 import os
 import shutil
+import subprocess
 import tempfile
+import threading
 import sys
 import types
 
@@ -34,8 +39,20 @@ import unittest.mock
 
 import logging
 import importlib.resources
+import importlib.util
+import qubesimgconverter
+import qubesadmin.exc
 import qubesappmenus
+import qubesappmenus.atomicfile
+import qubesappmenus.daemon
+import qubesappmenus.desktopmenu
+import qubesappmenus.desktoptemplate
+import qubesappmenus.iconindex
+import qubesappmenus.profiling
 import qubesappmenus.receive
+import qubesappmenus.snapshot
+import qubesappmenus.templatecache
+import qubesappmenus.tinting
 
 try:
     import qubesappmenusext
@@ -164,18 +181,35 @@ class TC_00_Appmenus(unittest.TestCase):
             updateable=False,
         )
         self.app = TestApp()
-        self.ext = qubesappmenus.Appmenus()
+        self.ext = qubesappmenus.Appmenus(
+            desktop_menu=qubesappmenus.desktopmenu.NativeDesktopMenu())
         self.basedir_obj = tempfile.TemporaryDirectory()
         self.basedir = self.basedir_obj.name
         self.basedir_patch = unittest.mock.patch('qubesappmenus.basedir',
             self.basedir)
         self.basedir_patch.start()
+        self.xdg_home_obj = tempfile.TemporaryDirectory()
+        self.xdg_data_home = os.path.join(self.xdg_home_obj.name, 'share')
+        self.xdg_config_home = os.path.join(self.xdg_home_obj.name, 'config')
+        self.xdg_data_home_patch = unittest.mock.patch(
+            'xdg.BaseDirectory.xdg_data_home', self.xdg_data_home)
+        self.xdg_data_home_patch.start()
+        self.xdg_config_home_patch = unittest.mock.patch(
+            'xdg.BaseDirectory.xdg_config_home', self.xdg_config_home)
+        self.xdg_config_home_patch.start()
+        self.metrics_path_patch = unittest.mock.patch.object(
+            qubesappmenusext.AppmenusExtension, 'metrics_path', None)
+        self.metrics_path_patch.start()
 
     def _make_desktop_name(self, vm, appmenu_basename):
         return os.path.join(self.ext.appmenus_dir(vm),
                             self.ext.desktop_name(vm, appmenu_basename))
 
     def tearDown(self):
+        self.metrics_path_patch.stop()
+        self.xdg_config_home_patch.stop()
+        self.xdg_data_home_patch.stop()
+        self.xdg_home_obj.cleanup()
         self.basedir_patch.stop()
         self.basedir_obj.cleanup()
         super(TC_00_Appmenus, self).tearDown()
@@ -190,22 +224,14 @@ class TC_00_Appmenus(unittest.TestCase):
 
     def assertUpdateScheduled(self, callback, should_schedule):
         ext = qubesappmenusext.AppmenusExtension()
-        collect_done_tasks = unittest.mock.Mock()
-        update_appmenus = unittest.mock.Mock(return_value='update-task')
-        with unittest.mock.patch.object(ext, 'collect_done_tasks',
-                collect_done_tasks), \
-                unittest.mock.patch.object(ext, 'update_appmenus',
-                    update_appmenus), \
-                unittest.mock.patch('asyncio.ensure_future') as ensure_future:
+        schedule_update = unittest.mock.Mock()
+        with unittest.mock.patch.object(ext, 'schedule_update',
+                schedule_update):
             callback(ext)
         if should_schedule:
-            collect_done_tasks.assert_called_once()
-            update_appmenus.assert_called_once()
-            ensure_future.assert_called_once_with('update-task')
+            schedule_update.assert_called_once()
         else:
-            collect_done_tasks.assert_not_called()
-            update_appmenus.assert_not_called()
-            ensure_future.assert_not_called()
+            schedule_update.assert_not_called()
 
     def test_000_appmenus_ext_template_for_dispvms_needs_feature(self):
         vm = TestAppmenusExtVM(
@@ -245,6 +271,220 @@ class TC_00_Appmenus(unittest.TestCase):
                 vm, None, 'appmenus-dispvm'),
             True)
 
+    def test_000_appmenus_ext_coalesce_updates(self):
+        vm = TestAppmenusExtVM()
+        ext = qubesappmenusext.AppmenusExtension()
+        ext.update_delay = 0
+        running = []
+        max_running = []
+
+        async def update(vm):
+            running.append(vm)
+            max_running.append(len(running))
+            await asyncio.sleep(0)
+            running.remove(vm)
+
+        async def run():
+            ext.label_setter(vm, None)
+            ext.on_feature_set_menu_items(vm, None, 'menu-items', 'a')
+            ext.on_feature_del_internal(vm, None, 'internal')
+            self.assertEqual(len(ext.vm_tasks[vm.name]), 1)
+            await ext.collect_pending_tasks(vm)
+            # event during an update in progress schedules another one
+            ext.label_setter(vm, None)
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            ext.label_setter(vm, None)
+            await ext.update_appmenus(vm)
+            await ext.collect_pending_tasks(vm)
+
+        with unittest.mock.patch.object(ext, '_update_appmenus',
+                side_effect=update) as update_appmenus:
+            asyncio.run(run())
+        self.assertEqual(update_appmenus.call_count, 4)
+        self.assertEqual(max(max_running), 1)
+        self.assertFalse(ext.update_scheduled)
+
+    def test_000_appmenus_ext_coalesce_during_update(self):
+        vm = TestAppmenusExtVM()
+        ext = qubesappmenusext.AppmenusExtension()
+        ext.update_delay = 0
+        updates = []
+
+        async def update(vm):
+            updates.append(vm)
+            if len(updates) == 1:
+                # events while the first update is in progress
+                ext.label_setter(vm, None)
+            await asyncio.sleep(0)
+
+        async def run():
+            ext.label_setter(vm, None)
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            # the second update is still scheduled, not started
+            self.assertEqual(ext.update_scheduled, {vm.name})
+            ext.label_setter(vm, None)
+            await ext.collect_pending_tasks(vm)
+
+        with unittest.mock.patch.object(ext, '_update_appmenus',
+                side_effect=update):
+            asyncio.run(run())
+        self.assertEqual(len(updates), 2)
+        self.assertFalse(ext.update_scheduled)
+
+    def test_000_appmenus_ext_update_many(self):
+        guivm = TestVM('sys-gui', klass='AppVM', running=True)
+        guivm.features['supported-rpc.qubes.UpdateAppMenusForMany'] = '1'
+        guivm.run_service_for_stdio = unittest.mock.AsyncMock()
+        other_guivm = TestVM('sys-gui2', klass='AppVM')
+        vms = [TestVM(name, klass='AppVM', guivm=guivm)
+               for name in ('test-vm2', 'test-vm1')]
+        other_vm = TestVM('test-vm3', klass='AppVM', guivm=other_guivm)
+        ext = qubesappmenusext.AppmenusExtension()
+        with unittest.mock.patch.object(ext, '_update_appmenus') \
+                as update_appmenus:
+            self.assertEqual(
+                asyncio.run(ext.update_appmenus_many(vms + [other_vm], guivm)),
+                ['test-vm3', 'test-vm1', 'test-vm2'])
+        update_appmenus.assert_called_once_with(other_vm)
+        guivm.run_service_for_stdio.assert_called_once_with(
+            'qubes.UpdateAppMenusForMany', input=b'test-vm1\ntest-vm2\n')
+
+        del guivm.features['supported-rpc.qubes.UpdateAppMenusForMany']
+        guivm.run_service_for_stdio.reset_mock()
+        with unittest.mock.patch.object(ext, '_update_appmenus') \
+                as update_appmenus:
+            asyncio.run(ext.update_appmenus_many(vms, guivm))
+        self.assertEqual(update_appmenus.call_args_list,
+            [unittest.mock.call(vm) for vm in vms])
+        guivm.run_service_for_stdio.assert_not_called()
+
+    def test_000_appmenus_ext_process_pending(self):
+        app = types.SimpleNamespace(domains={})
+        guivm = TestVM('sys-gui', klass='AppVM', running=True, app=app)
+        guivm.features['menu-remove-pending-for'] = 'test-rm1 test-rm2 test-rm3'
+        guivm.features['menu-update-pending-for'] = \
+            'test-vm1 test-vm2 test-vm3 test-rm1'
+        for name in ('test-vm1', 'test-vm2', 'test-vm3'):
+            app.domains[name] = TestVM(name, klass='AppVM', guivm=guivm)
+        ext = qubesappmenusext.AppmenusExtension()
+        ext.pending_concurrency = 2
+        running = []
+        max_running = []
+
+        async def operation(vm_name, **kwargs):
+            running.append(vm_name)
+            max_running.append(len(running))
+            await asyncio.sleep(0)
+            running.remove(vm_name)
+            if vm_name in ('test-rm2', 'test-vm2'):
+                raise ValueError('failed')
+            # failure already logged, or queued again
+            return vm_name != 'test-vm3'
+
+        async def update(vm):
+            return await operation(vm.name)
+
+        with unittest.mock.patch.object(ext, 'remove_appmenus',
+                side_effect=operation) as remove_appmenus, \
+                unittest.mock.patch.object(ext, 'update_appmenus',
+                side_effect=update) \
+                as update_appmenus:
+            asyncio.run(ext.on_domain_start(guivm, 'domain-start'))
+
+        self.assertEqual(remove_appmenus.call_count, 3)
+        self.assertEqual(update_appmenus.call_count, 3)
+        self.assertEqual(max(max_running), 2)
+        # failed operations stay queued
+        self.assertEqual(guivm.features['menu-remove-pending-for'],
+            'test-rm2')
+        self.assertEqual(guivm.features['menu-update-pending-for'],
+            'test-vm2 test-vm3')
+
+    def test_000_appmenus_ext_process_pending_many(self):
+        app = types.SimpleNamespace(domains={})
+        guivm = TestVM('sys-gui', klass='AppVM', running=True, app=app)
+        guivm.features['supported-rpc.qubes.UpdateAppMenusForMany'] = '1'
+        guivm.features['menu-update-pending-for'] = 'test-vm1 test-vm2'
+        for name in ('test-vm1', 'test-vm2'):
+            app.domains[name] = TestVM(name, klass='AppVM', guivm=guivm)
+        guivm.run_service_for_stdio = unittest.mock.AsyncMock(
+            side_effect=subprocess.CalledProcessError(1, 'x'))
+        ext = qubesappmenusext.AppmenusExtension()
+        asyncio.run(ext.on_domain_start(guivm, 'domain-start'))
+        # failed update stays queued
+        self.assertEqual(guivm.features['menu-update-pending-for'],
+            'test-vm1 test-vm2')
+
+        guivm.run_service_for_stdio.side_effect = None
+        asyncio.run(ext.on_domain_start(guivm, 'domain-start'))
+        self.assertNotIn('menu-update-pending-for', guivm.features)
+
+    def test_000_appmenus_ext_process_pending_stopped(self):
+        guivm = TestVM('sys-gui', klass='AppVM', running=True)
+        guivm.features['menu-remove-pending-for'] = 'test-rm1'
+        ext = qubesappmenusext.AppmenusExtension()
+        # GUI VM stopped in the meantime - queued again, not lost
+        guivm.running = False
+        asyncio.run(ext.process_queue(guivm, 'menu-remove-pending-for',
+            ['test-rm1'],
+            lambda vm_name: ext.remove_appmenus(vm_name, guivm=guivm)))
+        self.assertEqual(guivm.features['menu-remove-pending-for'],
+            'test-rm1')
+
+    def test_000_appmenus_ext_metrics(self):
+        guivm = TestVM('sys-gui', klass='AppVM', running=False)
+        guivm.features['supported-rpc.qubes.UpdateAppMenusFor'] = '1'
+        vm = TestVM('test-vm1', klass='AppVM', guivm=guivm)
+        vm2 = TestVM('test-vm2', klass='AppVM', guivm=guivm)
+        ext = qubesappmenusext.AppmenusExtension()
+        ext.update_delay = 0
+        ext.metrics_path = os.path.join(self.basedir, 'appmenus.prom')
+        ext.metrics_delay = 60
+
+        async def run():
+            ext.label_setter(TestAppmenusExtVM(), None)
+            ext.label_setter(TestAppmenusExtVM(), None)
+            await ext.update_appmenus(vm)
+            await ext.update_appmenus(vm2)
+            guivm.running = True
+            guivm.run_service_for_stdio = unittest.mock.AsyncMock(
+                side_effect=[None, subprocess.CalledProcessError(1, 'x')])
+            await ext.update_appmenus(vm)
+            await ext.update_appmenus(vm)
+            ext.dequeue(guivm, 'menu-update-pending-for', vm.name)
+            await ext.collect_pending_tasks(TestAppmenusExtVM())
+
+        with unittest.mock.patch.object(ext, '_delayed_update'), \
+                unittest.mock.patch.object(ext.metrics, 'export',
+                    wraps=ext.metrics.export) as export:
+            asyncio.run(run())
+            # writes are delayed, not done on each change
+            export.assert_not_called()
+            ext.flush_metrics()
+            export.assert_called_once_with(ext.metrics_path)
+        with open(ext.metrics_path, encoding='utf-8') as metrics_f:
+            metrics = metrics_f.read()
+        self.assertIn('\nqubes_appmenus_updates_requested_total 6\n',
+                      metrics)
+        self.assertIn('\nqubes_appmenus_updates_coalesced_total 1\n',
+                      metrics)
+        self.assertIn('\nqubes_appmenus_updates_queued_total{'
+            'feature="menu-update-pending-for",guivm="sys-gui"} 2\n',
+            metrics)
+        self.assertIn('\nqubes_appmenus_pending_queue_depth{'
+            'feature="menu-update-pending-for",guivm="sys-gui"} 1\n',
+            metrics)
+        self.assertIn('\nqubes_appmenus_updates_failed_total{'
+            'guivm="sys-gui",operation="update"} 1\n', metrics)
+        self.assertIn('\nqubes_appmenus_rpc_duration_seconds_bucket{'
+            'guivm="sys-gui",operation="update",le="+Inf"} 2\n', metrics)
+        self.assertIn('\nqubes_appmenus_rpc_duration_seconds_count{'
+            'guivm="sys-gui",operation="update"} 2\n', metrics)
+        self.assertIn('\nqubes_appmenus_tasks_pending 0\n', metrics)
+
 
     def test_000_templates_dirs(self):
         self.assertEqual(
@@ -645,6 +885,26 @@ class TC_00_Appmenus(unittest.TestCase):
         }
         self.assertEqual(expected_appmenus, appmenus)
 
+    def test_101_get_appmenus_line_limit(self):
+        stdout = io.BytesIO(b'evince.desktop:Name=Document Viewer\n' * 10)
+
+        def _run(service, **kwargs):
+            p = unittest.mock.Mock()
+            p.stdout = stdout
+            p.returncode = 0
+            return p
+        vm = TestVM('test-vm', klass='TemplateVM', run_service=_run)
+        lines = qubesappmenus.receive.read_appmenus_lines(vm)
+        with unittest.mock.patch('qubesappmenus.receive.appmenus_line_count',
+                                 3):
+            # lines are available before the whole output is read
+            self.assertEqual(next(lines),
+                             'evince.desktop:Name=Document Viewer')
+            self.assertFalse(stdout.closed)
+            with self.assertRaises(qubesadmin.exc.QubesException):
+                list(lines)
+        self.assertTrue(stdout.closed)
+
     def test_110_create_template(self):
         values = {
             'Name': 'Document Viewer',
@@ -716,6 +976,7 @@ class TC_00_Appmenus(unittest.TestCase):
 
     @unittest.mock.patch('subprocess.check_call')
     def test_120_create_appvm(self, mock_subprocess):
+        self.ext.desktop_menu = qubesappmenus.desktopmenu.XdgDesktopMenu()
         tpl = TestVM('test-inst-tpl',
             klass='TemplateVM',
             virt_mode='pvh',
@@ -795,6 +1056,7 @@ class TC_00_Appmenus(unittest.TestCase):
 
     @unittest.mock.patch('subprocess.check_call')
     def test_121_create_appvm_with_whitelist(self, mock_subprocess):
+        self.ext.desktop_menu = qubesappmenus.desktopmenu.XdgDesktopMenu()
         tpl = TestVM('test-inst-tpl',
             klass='TemplateVM',
             virt_mode='pvh',
@@ -957,6 +1219,235 @@ class TC_00_Appmenus(unittest.TestCase):
         self.assertIn('deprecated', stderr.getvalue())
 
 
+    def test_134_process_appmenus_templates_icon_failure(self):
+        def _run(service, **kwargs):
+            class PopenMockup(object):
+                pass
+            self.assertEqual(service, 'qubes.GetImageRGBA')
+            p = PopenMockup()
+            p.stdin = io.BytesIO()
+            p.stdin.close = lambda: None
+            p.stdout = io.BytesIO(b'1 1\nxxxx')
+
+            def wait():
+                p.returncode = 1 if b'cheese' in p.stdin.getvalue() else 0
+                return p.returncode
+            p.wait = wait
+            return p
+        self.appvm.run_service = _run
+        self.appvm.log = unittest.mock.Mock()
+        appmenus = {
+            'org.gnome.Cheese': {
+                'Name': 'Cheese',
+                'Icon': 'cheese',
+            },
+            'evince': {
+                'Name': 'Document Viewer',
+                'Icon': 'evince',
+            },
+        }
+
+        qubesappmenus.receive.process_appmenus_templates(self.ext,
+            self.appvm, appmenus, jobs=2)
+
+        self.assertNotIn('Icon', appmenus['org.gnome.Cheese'])
+        self.assertIn('Icon', appmenus['evince'])
+        icons_dir = self.ext.template_icons_dirs(self.appvm)[0]
+        self.assertEqual(os.listdir(icons_dir), ['evince.png'])
+        self.appvm.log.warning.assert_called_once()
+
+    def test_135_process_appmenus_templates_icons_shared(self):
+        requests = []
+
+        def _run(service, **kwargs):
+            class PopenMockup(object):
+                pass
+            self.assertEqual(service, 'qubes.GetImageRGBA')
+            p = PopenMockup()
+            p.stdin = io.BytesIO()
+            p.stdin.close = lambda: None
+            p.stdout = io.BytesIO(b'1 1\nxxxx')
+            p.returncode = 0
+            p.wait = lambda: p.returncode
+            requests.append(p.stdin)
+            return p
+        self.appvm.run_service = _run
+        self.appvm.log = unittest.mock.Mock()
+        appmenus = {
+            'evince': {
+                'Name': 'Document Viewer',
+                'Icon': 'evince',
+            },
+            'evince-previewer': {
+                'Name': 'Previewer',
+                'Icon': 'evince',
+            },
+        }
+
+        qubesappmenus.receive.process_appmenus_templates(self.ext,
+            self.appvm, appmenus)
+
+        # icon shared by both entries retrieved once
+        self.assertEqual(len(requests), 1)
+        icons_dir = self.ext.template_icons_dirs(self.appvm)[0]
+        self.assertEqual(sorted(os.listdir(icons_dir)),
+                         ['evince-previewer.png', 'evince.png'])
+
+    def test_136_icon_index(self):
+        def _run(service, **kwargs):
+            class PopenMockup(object):
+                pass
+            p = PopenMockup()
+            p.stdin = io.BytesIO()
+            p.stdin.close = lambda: None
+            p.stdout = io.BytesIO(b'1 1\nxxxx')
+            p.returncode = 0
+            p.wait = lambda: p.returncode
+            return p
+        tpl = TestVM('test-inst-tpl',
+            klass='TemplateVM',
+            virt_mode='pvh',
+            updateable=True,
+            provides_network=False,
+            label=self.app.labels[1])
+        tpl.run_service = _run
+        self.ext.appmenus_init(tpl)
+        appvm = TestVM('test-inst-app',
+            klass='AppVM',
+            template=tpl,
+            virt_mode='pvh',
+            updateable=False,
+            provides_network=False,
+            label=self.app.labels[1])
+        self.ext.appmenus_init(appvm)
+
+        for _ in range(2):
+            with unittest.mock.patch.object(qubesimgconverter.Image,
+                    'load_from_file') as load_from_file:
+                qubesappmenus.receive.process_appmenus_templates(self.ext,
+                    tpl, {'evince': {'Name': 'Document Viewer',
+                                     'Icon': 'evince'}})
+            # icon file is saved only the first time, and never compared
+            load_from_file.assert_not_called()
+
+        with unittest.mock.patch.object(qubesappmenus.tinting, 'tint_many',
+                wraps=qubesappmenus.tinting.tint_many) as tint_many:
+            self.ext.appicons_create(appvm)
+            self.assertEqual(len(tint_many.mock_calls), 1)
+            # the same icon and color - nothing to do, even when forced
+            self.ext.appicons_create(appvm, force=True)
+            self.assertEqual(len(tint_many.mock_calls), 1)
+            appvm.label = Label(2, '0x73d216', 'green')
+            self.ext.appicons_create(appvm)
+            self.assertEqual(len(tint_many.mock_calls), 2)
+
+    def test_137_shared_tinted_icons(self):
+        tpl = TestVM('test-inst-tpl',
+            klass='TemplateVM',
+            virt_mode='pvh',
+            updateable=True,
+            provides_network=False,
+            label=self.app.labels[1])
+        self.ext.appmenus_init(tpl)
+        icon = qubesimgconverter.Image.get_from_stream(
+            io.BytesIO(b'1 1\nxxxx'))
+        icon.save(os.path.join(self.ext.template_icons_dirs(tpl)[0],
+                               'evince.png'))
+        index = qubesappmenus.iconindex.IconIndex(
+            self.ext.template_icons_dirs(tpl)[0])
+        index.set('evince.png', qubesappmenus.iconindex.image_hash(icon))
+        index.save()
+        appvms = []
+        for name in ('test-inst-app1', 'test-inst-app2'):
+            appvm = TestVM(name,
+                klass='AppVM',
+                template=tpl,
+                virt_mode='pvh',
+                updateable=False,
+                provides_network=False,
+                label=self.app.labels[1])
+            self.ext.appmenus_init(appvm)
+            appvms.append(appvm)
+
+        with unittest.mock.patch.object(qubesappmenus.tinting, 'tint_many',
+                wraps=qubesappmenus.tinting.tint_many) as tint_many:
+            for appvm in appvms:
+                self.ext.appicons_create(appvm)
+            self.assertEqual(tint_many.mock_calls, [
+                unittest.mock.call('0xcc0000', [unittest.mock.ANY],
+                                   executor=None)])
+
+        icon_paths = [os.path.join(self.ext.icons_dir(appvm), 'evince.png')
+                      for appvm in appvms]
+        self.assertTrue(os.path.samefile(*icon_paths))
+        store = self.ext.tinted_icons_dir()
+        self.assertEqual(len(os.listdir(store)), 1)
+        self.ext.appicons_remove(appvms[0])
+        self.assertEqual(len(os.listdir(store)), 1)
+        self.ext.appicons_remove(appvms[1])
+        self.assertEqual(os.listdir(store), [])
+
+    @unittest.skipIf(qubesappmenus.tinting.numpy is None,
+                     'NumPy not available')
+    def test_138_tint_array(self):
+        src = os.path.join(self.basedir, 'src.png')
+        qubesimgconverter.Image(bytes(range(256)) * 4, (16, 16)).save(src)
+        self.assertIsNotNone(
+            qubesappmenus.tinting.lookup_table('0x73d216'))
+        qubesappmenus.tinting.tint_many('0x73d216', [
+            (src, os.path.join(self.basedir, 'array.png'))])
+        qubesimgconverter.tint(src, os.path.join(self.basedir, 'ref.png'),
+                               '0x73d216')
+        self.assertEqual(
+            qubesimgconverter.Image.load_from_file(
+                os.path.join(self.basedir, 'array.png')),
+            qubesimgconverter.Image.load_from_file(
+                os.path.join(self.basedir, 'ref.png')))
+
+    def test_139_tint_pool(self):
+        tpl = TestVM('test-inst-tpl',
+            klass='TemplateVM',
+            virt_mode='pvh',
+            updateable=True,
+            provides_network=False,
+            label=self.app.labels[1],
+            appvms=[])
+        self.ext.appmenus_init(tpl)
+        for name in ('evince', 'xterm'):
+            qubesimgconverter.Image(b'xxxx', (1, 1)).save(os.path.join(
+                self.ext.template_icons_dirs(tpl)[0], name + '.png'))
+        self.ext.tint_jobs = 2
+
+        with unittest.mock.patch('concurrent.futures.ProcessPoolExecutor',
+                side_effect=lambda max_workers, mp_context:
+                concurrent.futures.ThreadPoolExecutor(max_workers)) \
+                as pool_cls, \
+                unittest.mock.patch.object(qubesappmenus.tinting,
+                    'tint_many', wraps=qubesappmenus.tinting.tint_many) \
+                as tint_many, \
+                unittest.mock.patch.object(self.ext, 'appmenus_create'), \
+                unittest.mock.patch.object(self.ext, 'refresh_desktop_cache'):
+            self.ext.appmenus_update(tpl)
+            # the pool is kept for later updates
+            self.ext.appmenus_update(tpl, force=True)
+
+        self.assertEqual(len(tint_many.mock_calls), 2)
+        pool_cls.assert_called_once()
+        self.assertEqual(
+            pool_cls.call_args[1]['mp_context'].get_start_method(),
+            'forkserver')
+        executor = tint_many.call_args[1]['executor']
+        self.assertIsInstance(executor, concurrent.futures.ThreadPoolExecutor)
+        self.assertEqual(sorted(os.listdir(self.ext.icons_dir(tpl))),
+                         ['evince.png', 'xterm.png'])
+        # a single icon is tinted without the pool
+        self.assertIsNone(self.ext.tint_executor(1))
+
+        self.ext.close()
+        self.assertIsNone(self.ext._tint_executor)
+        with self.assertRaises(RuntimeError):
+            executor.submit(print)
+
     @unittest.mock.patch('subprocess.check_call')
     def test_140_remove_cleans_menu_files(self, mock_subprocess):
         tpl = TestVM('test-inst-tpl',
@@ -1014,6 +1505,890 @@ class TC_00_Appmenus(unittest.TestCase):
         finally:
             shutil.rmtree(config_dir)
 
+    def test_142_lazy_icons(self):
+        tpl = TestVM('test-inst-tpl',
+            klass='TemplateVM',
+            virt_mode='pvh',
+            updateable=True,
+            provides_network=False,
+            label=self.app.labels[1])
+        self.ext.appmenus_init(tpl)
+        icon = qubesimgconverter.Image(b'xxxx', (1, 1))
+        icon.save(os.path.join(self.ext.template_icons_dirs(tpl)[0],
+                               'evince.png'))
+        index = qubesappmenus.iconindex.IconIndex(
+            self.ext.template_icons_dirs(tpl)[0])
+        index.set('evince.png', qubesappmenus.iconindex.image_hash(icon))
+        index.save()
+        appvms = []
+        for name in ('test-inst-app1', 'test-inst-app2'):
+            appvm = TestVM(name,
+                klass='AppVM',
+                template=tpl,
+                virt_mode='pvh',
+                updateable=False,
+                provides_network=False,
+                label=self.app.labels[1])
+            self.ext.appmenus_init(appvm)
+            appvms.append(appvm)
+        self.ext.lazy_icons = True
+
+        self.ext.appicons_create(appvms[0])
+        self.assertEqual(os.listdir(self.ext.icons_dir(appvms[0])), [])
+        self.assertEqual(self.ext.pending_icons, {'test-inst-app1'})
+
+        # remembered across restarts
+        appmenus = qubesappmenus.Appmenus(lazy_icons=True)
+        appmenus.load_pending_icons()
+        self.assertEqual(appmenus.pending_icons, {'test-inst-app1'})
+
+        app = unittest.mock.MagicMock()
+        app.domains = {'test-inst-app1': appvms[0]}
+        daemon = qubesappmenus.daemon.AppmenusDaemon(app, self.ext)
+        daemon.idle_delay = 0
+        daemon.materialize_icons()
+        self.assertEqual(os.listdir(self.ext.icons_dir(appvms[0])),
+                         ['evince.png'])
+        self.assertEqual(self.ext.pending_icons, set())
+        self.assertPathNotExists(self.ext.pending_icons_path(appvms[0]))
+
+        # already tinted for the same label - linked even in lazy mode
+        self.ext.appicons_create(appvms[1])
+        self.assertEqual(os.listdir(self.ext.icons_dir(appvms[1])),
+                         ['evince.png'])
+        self.assertEqual(self.ext.pending_icons, set())
+
+    def test_143_template_index(self):
+        tpl = TestVM('test-inst-tpl',
+            klass='TemplateVM',
+            virt_mode='pvh',
+            updateable=True,
+            provides_network=False,
+            label=self.app.labels[1])
+        self.ext.appmenus_init(tpl)
+        appvm = TestVM('test-inst-app',
+            klass='AppVM',
+            template=tpl,
+            virt_mode='pvh',
+            updateable=False,
+            provides_network=False,
+            label=self.app.labels[1])
+        self.ext.appmenus_init(appvm)
+        expected_dirs = self.ext.template_icons_dirs(appvm)
+        expected_files = list(self.ext.get_available_filenames(appvm))
+
+        with self.ext.template_index(), \
+                unittest.mock.patch('os.listdir', wraps=os.listdir) \
+                as listdir:
+            self.assertEqual(self.ext.template_icons_dirs(appvm),
+                             expected_dirs)
+            for _ in range(3):
+                self.assertEqual(
+                    self.ext.template_for_file(
+                        self.ext.templates_dirs(appvm),
+                        'qubes-start.desktop'),
+                    os.path.join(self.ext.templates_dirs(tpl)[0],
+                                 'qubes-start.desktop'))
+                self.assertIsNone(self.ext.template_for_file(
+                    self.ext.templates_dirs(appvm), 'evince.desktop'))
+                self.assertEqual(
+                    list(self.ext.get_available_filenames(appvm)),
+                    expected_files)
+            self.assertEqual(len(listdir.mock_calls), 2)
+
+            # modified template directories are listed again
+            with open(os.path.join(self.ext.templates_dirs(tpl)[0],
+                    'evince.desktop'), 'wb') as f:
+                f.write(importlib.resources.files(
+                    __package__).joinpath(
+                    'test-data/evince.desktop.template').read_bytes())
+            self.ext.appmenus_init(appvm)
+            self.assertIsNotNone(self.ext.template_for_file(
+                self.ext.templates_dirs(appvm), 'evince.desktop'))
+
+    def test_144_template_cache(self):
+        tpl = TestVM('test-inst-tpl',
+            klass='TemplateVM',
+            virt_mode='pvh',
+            updateable=True,
+            provides_network=False,
+            label=self.app.labels[1])
+        self.ext.appmenus_init(tpl)
+        evince_path = os.path.join(self.ext.templates_dirs(tpl)[0],
+                                   'evince.desktop')
+        with open(evince_path, 'wb') as f:
+            f.write(importlib.resources.files(
+                __package__).joinpath(
+                'test-data/evince.desktop.template').read_bytes())
+        appvms = [TestVM(name,
+            klass='AppVM',
+            template=tpl,
+            virt_mode='pvh',
+            updateable=False,
+            provides_network=False,
+            label=self.app.labels[1])
+            for name in ('test-inst-app1', 'test-inst-app2')]
+
+        expected = [['evince.desktop', 'Document Viewer'],
+                    ['qubes-start.desktop', 'Start qube']]
+        with unittest.mock.patch.object(qubesappmenus.templatecache,
+                'parse_template',
+                wraps=qubesappmenus.templatecache.parse_template) as parse:
+            for appvm in appvms:
+                self.assertEqual(sorted(self.ext.get_available(appvm)),
+                                 expected)
+                self.assertEqual(
+                    sorted(self.ext.get_available(appvm, fields=['Icon'])),
+                    [['evince.desktop', 'Document Viewer',
+                      '%VMDIR%/apps.icons/evince.png'],
+                     ['qubes-start.desktop', 'Start qube', '%XDGICON%']])
+            self.assertEqual(len(parse.mock_calls), 2)
+
+            # persistent index is used by a new instance
+            appmenus = qubesappmenus.Appmenus(
+                desktop_menu=qubesappmenus.desktopmenu.NativeDesktopMenu())
+            self.assertEqual(sorted(appmenus.get_available(appvms[0])),
+                             expected)
+            self.assertEqual(len(parse.mock_calls), 2)
+
+            # modified template is parsed again
+            with open(evince_path, 'a', encoding='utf-8') as f:
+                f.write('[Desktop Action new-window]\nName=New Window\n')
+            self.assertEqual(sorted(appmenus.get_available(appvms[0])),
+                             expected)
+            self.assertEqual(len(parse.mock_calls), 3)
+
+        # index is replaced atomically and drops removed templates
+        templates_dir = os.path.dirname(evince_path)
+        other_path = os.path.join(templates_dir, 'other.desktop')
+        os.rename(evince_path, other_path)
+        appmenus.template_cache.get(other_path)
+        with unittest.mock.patch('qubesappmenus.atomicfile.write_file',
+                wraps=qubesappmenus.atomicfile.write_file) as write_file:
+            appmenus.template_cache.save()
+        index = qubesappmenus.templatecache.ParsedTemplates(templates_dir)
+        write_file.assert_called_once_with(index.path, unittest.mock.ANY)
+        self.assertIn('other.desktop', index.entries)
+        self.assertNotIn('evince.desktop', index.entries)
+        self.assertEqual([f for f in os.listdir(os.path.dirname(index.path))
+                          if f.endswith('.tmp')], [])
+
+    @unittest.mock.patch('qubesappmenus.Appmenus')
+    def test_145_get_json(self, appmenus_cls):
+        vm1 = TestVM('test-inst-vm1', klass='AppVM',
+            label=self.app.labels[1])
+        vm2 = TestVM('test-inst-vm2', klass='AppVM',
+            label=self.app.labels[1])
+        self.app.domains[vm1.name] = vm1
+        self.app.domains[vm2.name] = vm2
+        appmenus_cls.return_value.get_available.side_effect = [
+            [('xterm.desktop', 'XTerm', 'a|b')],
+            OSError('broken template')]
+        vm1.features['menu-items'] = 'xterm.desktop'
+        appmenus_cls.return_value.get_whitelist.side_effect = \
+            self.ext.get_whitelist
+
+        with unittest.mock.patch('sys.stdout', new_callable=io.StringIO) \
+                as stdout:
+            qubesappmenus.main(
+                ['--force-root', '--json', '--get-available',
+                 '--get-whitelist', '--file-field', 'Comment',
+                 vm1.name, vm2.name], app=self.app)
+
+        self.assertEqual(
+            [json.loads(line) for line in stdout.getvalue().splitlines()], [
+                {'qube': 'test-inst-vm1', 'type': 'whitelist',
+                 'entries': ['xterm.desktop']},
+                {'qube': 'test-inst-vm1', 'type': 'available',
+                 'file': 'xterm.desktop', 'name': 'XTerm',
+                 'fields': {'Comment': 'a|b'}},
+                {'qube': 'test-inst-vm2', 'type': 'error',
+                 'message': 'broken template'},
+            ])
+
+    def test_146_desktop_template(self):
+        source = ('[Desktop Entry]\nName=%VMNAME%: Xterm\n'
+                  'Icon=%VMDIR%/apps.icons/xterm.png\n'
+                  'Exec=qvm-run -q -a --service -- %VMNAME% qubes.StartApp\n'
+                  'X-Qubes-DispvmExec=qvm-run -q -a --service '
+                  '--dispvm=%VMNAME% -- qubes.StartApp\n'
+                  'X-Qubes-VmName=%VMNAME%%XDGICON%\n')
+        template = qubesappmenus.desktoptemplate.DesktopTemplate(source)
+        self.assertTrue(template.uses_icon)
+        self.assertEqual(template.render(('vm', '/dir', 'icon')),
+            source.replace('%VMNAME%', 'vm').replace('%VMDIR%', '/dir').
+            replace('%XDGICON%', 'icon'))
+        self.assertEqual(template.render(('vm', '/dir', 'icon'), True),
+            source.replace('\nExec=', '\nX-Qubes-NonDispvmExec=').
+            replace('\nX-Qubes-DispvmExec=', '\nExec=').
+            replace('\nName=%VMNAME%', '\nName=%VMNAME% (dvm)').
+            replace('%VMNAME%', 'vm').replace('%VMDIR%', '/dir').
+            replace('%XDGICON%', 'icon'))
+
+        no_dispvm = qubesappmenus.desktoptemplate.DesktopTemplate(
+            '[Desktop Entry]\nExec=xterm\n')
+        self.assertIsNone(no_dispvm.dispvm)
+        self.assertFalse(no_dispvm.uses_icon)
+        with self.assertRaises(qubesappmenus.DispvmNotSupportedError):
+            self.ext.write_desktop_file(self.appvm, no_dispvm,
+                os.path.join(self.basedir, 'out.desktop'), dispvm=True)
+
+        path = os.path.join(self.basedir, 'xterm.desktop')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(source)
+        self.assertIs(self.ext.desktop_template(path),
+                      self.ext.desktop_template(path))
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write('Comment=Terminal\n')
+        self.assertEqual(self.ext.desktop_template(path).normal[-1],
+                         '\nComment=Terminal\n')
+
+    def test_147_atomic_write(self):
+        path = os.path.join(self.basedir, 'xterm.desktop')
+        other_path = os.path.join(self.basedir, 'sub', 'other.desktop')
+        os.mkdir(os.path.dirname(other_path))
+        with unittest.mock.patch('qubesappmenus.atomicfile.fsync_dir') \
+                as mock_fsync:
+            with qubesappmenus.atomicfile.sync_batch():
+                qubesappmenus.atomicfile.write_file(path, 'one')
+                with open(path, encoding='utf-8') as f:
+                    old_f = f
+                    qubesappmenus.atomicfile.write_file(path, 'two')
+                    # file replaced, not rewritten in place
+                    self.assertEqual(old_f.read(), 'one')
+                qubesappmenus.atomicfile.write_file(other_path, 'three')
+                mock_fsync.assert_not_called()
+            self.assertEqual(sorted(mock_fsync.mock_calls), [
+                unittest.mock.call(self.basedir),
+                unittest.mock.call(os.path.dirname(other_path)),
+            ])
+            mock_fsync.reset_mock()
+            with unittest.mock.patch('os.fsync', wraps=os.fsync) \
+                    as mock_fsync_file:
+                qubesappmenus.atomicfile.write_file(path, 'four')
+            # content synced before the rename
+            mock_fsync_file.assert_called_once()
+            mock_fsync.assert_called_once_with(self.basedir)
+        with open(path, encoding='utf-8') as f:
+            self.assertEqual(f.read(), 'four')
+        self.assertEqual(sorted(os.listdir(self.basedir)),
+                         ['sub', 'xterm.desktop'])
+
+        # unchanged file is not replaced
+        inode = os.stat(path).st_ino
+        self.assertFalse(self.ext.write_desktop_file(self.appvm,
+            qubesappmenus.desktoptemplate.DesktopTemplate('four'), path))
+        self.assertEqual(os.stat(path).st_ino, inode)
+        self.assertTrue(self.ext.write_desktop_file(self.appvm,
+            qubesappmenus.desktoptemplate.DesktopTemplate('five'), path))
+        self.assertNotEqual(os.stat(path).st_ino, inode)
+
+        # indexes are replaced atomically too
+        index = qubesappmenus.iconindex.IconIndex(
+            os.path.dirname(other_path))
+        index.set('icon.png', 'hash')
+        with unittest.mock.patch('qubesappmenus.atomicfile.write_file',
+                wraps=qubesappmenus.atomicfile.write_file) as write_file:
+            index.save()
+        write_file.assert_called_once_with(
+            os.path.dirname(other_path) + '.index', '{"icon.png": "hash"}')
+
+    def test_148_manifest(self):
+        tpl = TestVM('test-inst-tpl',
+            klass='TemplateVM',
+            virt_mode='pvh',
+            updateable=True,
+            provides_network=False,
+            label=self.app.labels[1])
+        self.ext.appmenus_init(tpl)
+        evince_path = os.path.join(self.ext.templates_dirs(tpl)[0],
+                                   'evince.desktop')
+        with open(evince_path, 'wb') as f:
+            f.write(importlib.resources.files(
+                __package__).joinpath(
+                'test-data/evince.desktop.template').read_bytes())
+        appvm = TestVM('test-inst-app',
+            klass='AppVM',
+            template=tpl,
+            virt_mode='pvh',
+            updateable=False,
+            provides_network=False,
+            label=self.app.labels[1])
+        self.ext.appmenus_init(appvm)
+        self.ext.appmenus_create(appvm, refresh_cache=False)
+        appmenus_dir = self.ext.appmenus_dir(appvm)
+        self.assertTrue(os.path.exists(appmenus_dir + '.manifest'))
+        evince_dest = os.path.join(appmenus_dir,
+            'org.qubes-os.vm._test_dinst_dapp.evince.desktop')
+
+        # unchanged entries are neither rendered nor compared
+        with unittest.mock.patch.object(self.ext, 'write_desktop_file') \
+                as write:
+            self.ext.appmenus_create(appvm, refresh_cache=False)
+            write.assert_not_called()
+
+        # changed template is rendered again
+        stat = os.stat(evince_path)
+        os.utime(evince_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        with unittest.mock.patch.object(self.ext, 'write_desktop_file',
+                wraps=self.ext.write_desktop_file) as write:
+            self.ext.appmenus_create(appvm, refresh_cache=False)
+            self.assertEqual([call[1][2] for call in write.mock_calls],
+                             [evince_dest])
+
+        # removed files are re-created
+        os.unlink(evince_dest)
+        self.ext.appmenus_create(appvm, refresh_cache=False)
+        self.assertTrue(os.path.exists(evince_dest))
+
+        # force compares all of them
+        with unittest.mock.patch.object(self.ext, 'write_desktop_file',
+                wraps=self.ext.write_desktop_file) as write:
+            self.ext.appmenus_create(appvm, force=True, refresh_cache=False)
+            self.assertEqual(len(write.mock_calls),
+                             len(os.listdir(appmenus_dir)))
+
+        self.ext.appmenus_remove(appvm, refresh_cache=False)
+        self.assertFalse(os.path.exists(appmenus_dir + '.manifest'))
+
+    def test_149_benchmark(self):
+        # development tool, available only in the source tree
+        path = os.path.join(os.path.dirname(__file__), os.pardir, 'tools',
+                            'appmenus_benchmark.py')
+        if not os.path.exists(path):
+            self.skipTest('benchmark not available')
+        spec = importlib.util.spec_from_file_location('appmenus_benchmark',
+                                                      path)
+        benchmark = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(benchmark)
+        args = benchmark.parser.parse_args([
+            '--templates', '1', '--appvms', '2', '--entries', '3',
+            '--icon-size', '4', '--tint-jobs', '1'])
+        results = benchmark.run(args, self.basedir)
+        self.assertEqual([result['phase'] for result in results], [
+            'appmenus_init',
+            'process_appmenus_templates',
+            'appicons_create',
+            'appmenus_create',
+            'get_available',
+            'appmenus_update',
+            'appmenus_update (forced)',
+        ])
+        for result in results:
+            self.assertGreater(result['file_ops'], 0)
+            self.assertGreater(result['peak_rss_kib'], 0)
+        self.assertEqual(len(os.listdir(os.path.join(
+            self.basedir, 'bench-app-0-1', 'apps'))), 6)
+
+    @unittest.mock.patch('subprocess.check_call')
+    def test_150_native_desktop_menu(self, mock_subprocess):
+        tpl = TestVM('test-inst-tpl',
+            klass='TemplateVM',
+            virt_mode='pvh',
+            updateable=True,
+            provides_network=False,
+            label=self.app.labels[1])
+        self.ext.appmenus_init(tpl)
+        with open(os.path.join(self.ext.templates_dirs(tpl)[0],
+                'evince.desktop'), 'wb') as f:
+            f.write(importlib.resources.files(
+                __package__).joinpath(
+                'test-data/evince.desktop.template').read_bytes())
+        appvm = TestVM('test-inst-app',
+            klass='AppVM',
+            template=tpl,
+            virt_mode='pvh',
+            updateable=False,
+            provides_network=False,
+            label=self.app.labels[1])
+        self.ext.appmenus_init(appvm)
+        self.ext.appmenus_create(appvm, refresh_cache=False)
+        mock_subprocess.assert_not_called()
+
+        applications_dir = os.path.join(self.xdg_data_home, 'applications')
+        evince_name = self.ext.desktop_name(appvm, 'evince.desktop')
+        with open(os.path.join(applications_dir, evince_name), 'rb') as f:
+            with open(self._make_desktop_name(appvm, 'evince.desktop'),
+                      'rb') as orig_f:
+                self.assertEqual(f.read(), orig_f.read())
+        self.assertPathExists(os.path.join(self.xdg_data_home,
+            'desktop-directories',
+            'qubes-vm-directory_test_dinst_dapp.directory'))
+
+        menu_path = os.path.join(self.xdg_config_home, 'menus',
+            'applications-merged',
+            'user-qubes-vm-directory_test_dinst_dapp.menu')
+        with open(menu_path) as f:
+            menu = f.read()
+        self.assertTrue(menu.startswith(
+            '<!DOCTYPE Menu PUBLIC "-//freedesktop//DTD Menu 1.0//EN"\n'
+            '    "http://www.freedesktop.org/standards/menu-spec/'
+            'menu-1.0.dtd">\n'
+            '<!-- Do not edit manually - generated and managed by '
+            'xdg-desktop-menu -->\n'
+            '<Menu>\n'
+            '    <Name>Applications</Name>\n'
+            '<Menu>\n'
+            '    <Name>qubes-vm-directory_test_dinst_dapp</Name>\n'
+            '    <Directory>qubes-vm-directory_test_dinst_dapp.directory'
+            '</Directory>\n'
+            '    <Include>\n'))
+        self.assertTrue(menu.endswith(
+            '    </Include>\n'
+            '</Menu>\n'
+            '</Menu>\n'))
+        self.assertIn('        <Filename>' + evince_name + '</Filename>\n',
+            menu)
+        self.assertEqual(menu.count('<Filename>'), 3)
+
+        self.ext.appmenus_remove(appvm, refresh_cache=False)
+        self.assertPathNotExists(menu_path)
+        self.assertPathNotExists(os.path.join(applications_dir, evince_name))
+        mock_subprocess.assert_not_called()
+
+    @unittest.mock.patch.dict(os.environ,
+        {qubesappmenus.profiling.ENV_VAR: ''})
+    @unittest.mock.patch('qubesappmenus.profiling.profile',
+        new_callable=qubesappmenus.profiling.Profile)
+    def test_151_profile(self, profile):
+        app = unittest.mock.Mock()
+        qubesd_call = app.qubesd_call
+        self.assertIsNone(qubesappmenus.profiling.setup(None, app))
+        self.assertIs(app.qubesd_call, qubesd_call)
+        self.ext.appmenus_init(self.appvm)
+        self.assertEqual(profile.summary()['phases'], {})
+
+        os.environ[qubesappmenus.profiling.ENV_VAR] = 'json'
+        self.assertEqual(qubesappmenus.profiling.setup(None, app), 'json')
+        app.qubesd_call('dom0', 'admin.vm.List')
+        qubesd_call.assert_called_once_with('dom0', 'admin.vm.List')
+
+        tpl = TestVM('test-inst-tpl',
+            klass='TemplateVM',
+            virt_mode='pvh',
+            updateable=True,
+            provides_network=False,
+            label=self.app.labels[1])
+        self.ext.appmenus_init(tpl)
+        for _ in range(2):
+            self.ext.appmenus_create(tpl, refresh_cache=False)
+
+        output = io.StringIO()
+        profile.report('json', file=output)
+        summary = json.loads(output.getvalue())
+        self.assertEqual(summary['phases']['admin-api']['calls'], 1)
+        self.assertEqual(summary['phases']['appmenus_init']['calls'], 1)
+        self.assertEqual(summary['phases']['appmenus_create']['calls'], 2)
+        # directory, Start and settings entries
+        self.assertEqual(summary['counters'], {
+            'files-rendered': 3,
+            'files-written': 3,
+            'files-skipped': 3,
+        })
+
+    def test_152_prefetch(self):
+        calls = []
+
+        class CountingFeatures(TestFeatures):
+            def get(self, feature, default=None):
+                calls.append(('get', self.vm.name, feature))
+                return super().get(feature, default)
+
+            def check_with_template(self, feature, default=None):
+                calls.append(('check_with_template', self.vm.name, feature))
+                return super().check_with_template(feature, default)
+
+        app = types.SimpleNamespace(cache_enabled=False)
+        tpl = TestVM('test-inst-tpl', klass='TemplateVM',
+            label=self.app.labels[1])
+        appvm = TestVM('test-inst-app', klass='AppVM', template=tpl,
+            label=self.app.labels[1])
+        tpl.features = CountingFeatures(tpl, **{'appmenus-legacy': '1'})
+        appvm.features = CountingFeatures(appvm,
+                                          **{'menu-items': 'xterm.desktop'})
+        tpl_features = tpl.features
+        appvm_features = appvm.features
+
+        # no property cache in the client - nothing to gain
+        with qubesappmenus.snapshot.prefetch(types.SimpleNamespace(),
+                                             [appvm]):
+            self.assertIs(appvm.features, appvm_features)
+
+        with qubesappmenus.snapshot.prefetch(app, [appvm]):
+            self.assertTrue(app.cache_enabled)
+            calls.clear()
+            for _ in range(3):
+                self.assertEqual(appvm.features.get('menu-items'),
+                                 'xterm.desktop')
+                self.assertIn('menu-items', appvm.features)
+                self.assertNotIn('internal', appvm.features)
+                self.assertIsNone(appvm.features.get('internal'))
+                self.assertEqual(appvm.features.check_with_template(
+                    'appmenus-legacy', False), '1')
+                self.assertFalse(tpl.features.get('internal', False))
+            # each feature retrieved only once
+            self.assertEqual(len(calls), 5)
+            self.assertEqual(sorted(set(calls)), sorted(calls))
+
+            # changes are passed through
+            appvm.features['internal'] = '1'
+            self.assertEqual(appvm_features['internal'], '1')
+            self.assertEqual(appvm.features['internal'], '1')
+            del appvm.features['internal']
+            self.assertNotIn('internal', appvm_features)
+            self.assertNotIn('internal', appvm.features)
+
+            self.assertIsInstance(tpl.features,
+                                  qubesappmenus.snapshot.FeaturesSnapshot)
+            self.assertIs(tpl.features.features, tpl_features)
+
+        # original objects restored, nothing stale left behind
+        self.assertIs(appvm.features, appvm_features)
+        self.assertIs(tpl.features, tpl_features)
+        self.assertFalse(app.cache_enabled)
+
+        # qubes based on a template
+        tpl2 = TestVM('test-inst-tpl2', klass='TemplateVM')
+        appvm2 = TestVM('test-inst-app2', klass='AppVM', template=tpl2)
+        tpl2.appvms = [appvm2]
+        with qubesappmenus.snapshot.prefetch(app, [tpl2], children=True):
+            self.assertIsInstance(appvm2.features,
+                                  qubesappmenus.snapshot.FeaturesSnapshot)
+
+    @unittest.mock.patch('qubesappmenus.Appmenus')
+    def test_153_prefetch_main(self, appmenus_cls):
+        calls = []
+
+        class CountingVM(TestVM):
+            def __getattribute__(self, name):
+                if name in qubesappmenus.snapshot.PROPERTIES:
+                    calls.append(('property', name))
+                return super().__getattribute__(name)
+
+        class CountingFeatures(TestFeatures):
+            def get(self, feature, default=None):
+                calls.append(('feature', feature))
+                return super().get(feature, default)
+
+        self.app.cache_enabled = False
+        vm = CountingVM('test-inst-vm', klass='AppVM',
+            label=self.app.labels[1])
+        vm.features = CountingFeatures(vm, **{'menu-items': 'xterm.desktop'})
+        features = vm.features
+        self.app.domains[vm.name] = vm
+        # properties and features of each VM are used many times
+        batch_calls = []
+
+        def update_batch(vms, **kwargs):
+            batch_calls.append(list(calls))
+            for _ in range(3):
+                for updated_vm in vms:
+                    self.assertTrue(self.app.cache_enabled)
+                    updated_vm.features.get('menu-items')
+
+        appmenus_cls.return_value.appmenus_update_batch.side_effect = \
+            update_batch
+        with unittest.mock.patch('qubesadmin.vm.QubesVM', CountingVM):
+            qubesappmenus.main(['--force-root', '--update', vm.name],
+                               app=self.app)
+
+        # the name from the command line was resolved and prefetched
+        self.assertEqual(len(batch_calls), 1)
+        self.assertLessEqual(
+            set(qubesappmenus.snapshot.PROPERTIES),
+            {name for kind, name in batch_calls[0] if kind == 'property'})
+        # feature retrieved only once
+        self.assertEqual(calls.count(('feature', 'menu-items')), 1)
+        self.assertIs(vm.features, features)
+        self.assertFalse(self.app.cache_enabled)
+
+    def test_154_native_desktop_menu_golden(self):
+        def make_files(*names):
+            paths = []
+            for name in names:
+                path = os.path.join(self.basedir, name)
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write('[Desktop Entry]\n')
+                paths.append(path)
+            return paths
+
+        desktop_menu = qubesappmenus.desktopmenu.NativeDesktopMenu()
+        directory_files = make_files('qubes-test.directory',
+                                     'nested.directory')
+        desktop_menu.install(directory_files + make_files(
+            'beta_2.desktop', 'beta.desktop', 'alpha.desktop',
+            'removed.desktop'), refresh_cache=False)
+        desktop_menu.install(directory_files + make_files(
+            'beta.desktop', 'Zeta.desktop', 'beta-2.desktop'),
+            refresh_cache=False)
+        desktop_menu.uninstall(directory_files + make_files(
+            'removed.desktop'), refresh_cache=False)
+        desktop_menu.install(directory_files, refresh_cache=False)
+
+        with open(desktop_menu.menu_path(directory_files), 'rb') as f:
+            self.assertEqual(f.read(), importlib.resources.files(
+                __package__).joinpath(
+                'test-data/user-qubes-test-nested.menu').read_bytes())
+
+    def test_155_shared_tinted_icon_released(self):
+        tpl = TestVM('test-inst-tpl',
+            klass='TemplateVM',
+            virt_mode='pvh',
+            updateable=True,
+            provides_network=False,
+            label=self.app.labels[1])
+        self.ext.appmenus_init(tpl)
+        icon = qubesimgconverter.Image.get_from_stream(
+            io.BytesIO(b'1 1\nxxxx'))
+        icon.save(os.path.join(self.ext.template_icons_dirs(tpl)[0],
+                               'evince.png'))
+        index = qubesappmenus.iconindex.IconIndex(
+            self.ext.template_icons_dirs(tpl)[0])
+        index.set('evince.png', qubesappmenus.iconindex.image_hash(icon))
+        index.save()
+        appvms = []
+        for name in ('test-inst-app1', 'test-inst-app2'):
+            appvm = TestVM(name,
+                klass='AppVM',
+                template=tpl,
+                virt_mode='pvh',
+                updateable=False,
+                provides_network=False,
+                label=self.app.labels[1])
+            self.ext.appmenus_init(appvm)
+            appvms.append(appvm)
+        self.ext.appicons_create(appvms[0])
+        store_path, = [os.path.join(self.ext.tinted_icons_dir(), name)
+                       for name in os.listdir(self.ext.tinted_icons_dir())]
+
+        real_link = os.link
+        released = []
+
+        def release_and_link(src, dst):
+            # the other VM is removed between the check and the link
+            if not released:
+                released.append(src)
+                self.ext.appicons_remove(appvms[0])
+            real_link(src, dst)
+
+        with unittest.mock.patch('os.link', side_effect=release_and_link), \
+                unittest.mock.patch.object(qubesappmenus.tinting,
+                    'tint_many', wraps=qubesappmenus.tinting.tint_many) \
+                as tint_many:
+            self.ext.appicons_create(appvms[1])
+        tint_many.assert_called_once()
+        icon_path = os.path.join(self.ext.icons_dir(appvms[1]), 'evince.png')
+        self.assertTrue(os.path.samefile(icon_path, store_path))
+        self.assertEqual(released, [store_path])
+        self.assertEqual(os.stat(store_path).st_nlink, 2)
+
+    @unittest.mock.patch.dict(os.environ,
+        {qubesappmenus.profiling.ENV_VAR: 'json'})
+    @unittest.mock.patch('qubesappmenus.profiling.profile',
+        new_callable=qubesappmenus.profiling.Profile)
+    @unittest.mock.patch('qubesappmenus.Appmenus')
+    def test_156_profile_failed_run(self, appmenus_cls, profile):
+        vm = TestVM('test-inst-vm', klass='AppVM',
+            label=self.app.labels[1])
+        self.app.domains[vm.name] = vm
+        self.app.qubesd_call = unittest.mock.Mock()
+
+        def appmenus_init(vm, src=None):
+            self.app.qubesd_call(vm.name, 'admin.vm.feature.Get')
+            raise OSError('disk full')
+
+        appmenus_cls.return_value.appmenus_init.side_effect = appmenus_init
+
+        with unittest.mock.patch('sys.stderr', new_callable=io.StringIO) \
+                as stderr:
+            with self.assertRaises(OSError):
+                qubesappmenus.main(['--force-root', '--init', vm.name],
+                                   app=self.app)
+        self.assertTrue(profile.enabled)
+        summary = json.loads(stderr.getvalue())
+        self.assertEqual(summary['phases']['admin-api']['calls'], 1)
+
+    def test_160_update_batch(self):
+        app = types.SimpleNamespace(local_name='dom0')
+        tpl = TestVM('test-inst-tpl', klass='TemplateVM', app=app)
+        appvm1 = TestVM('test-inst-app1', klass='AppVM', template=tpl,
+            guivm='dom0', app=app)
+        appvm2 = TestVM('test-inst-app2', klass='AppVM', template=tpl,
+            guivm='dom0', app=app)
+        other_guivm = TestVM('test-inst-app3', klass='AppVM', template=tpl,
+            guivm='sys-gui', app=app)
+        tpl.appvms = [appvm1, appvm2, other_guivm]
+        for vm in (tpl, appvm1, appvm2, other_guivm):
+            os.makedirs(os.path.join(self.basedir, vm.name))
+        self.ext.desktop_menu = unittest.mock.Mock()
+        with unittest.mock.patch.object(self.ext, 'appicons_create') \
+                as appicons_create, \
+                unittest.mock.patch.object(self.ext, 'appmenus_create') \
+                as appmenus_create:
+            self.ext.appmenus_update_batch([tpl, appvm1], force=True)
+
+        self.assertEqual(appicons_create.mock_calls, [
+            unittest.mock.call(tpl, force=True),
+            unittest.mock.call(appvm1, force=True),
+            unittest.mock.call(appvm2, force=True),
+        ])
+        self.assertEqual(appmenus_create.mock_calls, [
+            unittest.mock.call(tpl, force=True, refresh_cache=False),
+            unittest.mock.call(appvm1, force=True, refresh_cache=False),
+            unittest.mock.call(appvm2, refresh_cache=False),
+        ])
+        self.ext.desktop_menu.forceupdate.assert_called_once_with()
+
+    def test_161_update_batch_parallel(self):
+        app = types.SimpleNamespace(local_name='dom0')
+        tpl = TestVM('test-inst-tpl', klass='TemplateVM', app=app)
+        appvms = [TestVM('test-inst-app{}'.format(i), klass='AppVM',
+                         template=tpl, guivm='dom0', app=app)
+                  for i in range(4)]
+        dispvm = TestVM('test-inst-disp', klass='DispVM', template=appvms[0],
+            guivm='dom0', app=app)
+        tpl.appvms = appvms
+        appvms[0].appvms = [dispvm]
+        for vm in [tpl, dispvm] + appvms:
+            os.makedirs(os.path.join(self.basedir, vm.name))
+        self.ext.desktop_menu = unittest.mock.Mock()
+        done = []
+        barrier = threading.Barrier(len(appvms), timeout=5)
+
+        def appicons_create(vm, force=False):
+            vm.log.warning('icons of %s', vm.name)
+            if vm.klass == 'AppVM':
+                # all AppVMs run at the same time
+                barrier.wait()
+            # templates are processed before VMs based on them
+            if hasattr(vm, 'template'):
+                self.assertIn(vm.template.name, done)
+            vm.log.warning('done %s', vm.name)
+            done.append(vm.name)
+
+        handler = logging.Handler()
+        handler.emit = unittest.mock.Mock()
+        logger = logging.getLogger()
+        with unittest.mock.patch.object(self.ext, 'appicons_create',
+                    side_effect=appicons_create), \
+                unittest.mock.patch.object(self.ext, 'appmenus_create'), \
+                unittest.mock.patch.object(logger, 'handlers', [handler]):
+            self.ext.appmenus_update_batch(
+                [appvms[3], tpl, dispvm], force=True, jobs=4)
+            self.assertEqual(logger.handlers, [handler])
+            self.assertEqual(handler.filters, [])
+
+        self.assertEqual(done[0], 'test-inst-tpl')
+        self.assertEqual(done[-1], 'test-inst-disp')
+        # messages grouped per VM, in order of the listed VMs, then
+        # children
+        self.assertEqual(
+            [call.args[0].getMessage() for call in handler.emit.mock_calls],
+            [msg.format(name)
+             for name in ('test-inst-tpl', 'test-inst-app3', 'test-inst-app0',
+                          'test-inst-app1', 'test-inst-app2',
+                          'test-inst-disp')
+             for msg in ('icons of {}', 'done {}')])
+        self.ext.desktop_menu.forceupdate.assert_called_once_with()
+
+    def test_162_update_batch_parallel_failure(self):
+        app = types.SimpleNamespace(local_name='dom0')
+        tpl = TestVM('test-inst-tpl', klass='TemplateVM', app=app)
+        appvms = [TestVM('test-inst-app{}'.format(i), klass='AppVM',
+                         template=tpl, guivm='dom0', app=app)
+                  for i in range(4)]
+        tpl.appvms = appvms
+        for vm in [tpl] + appvms:
+            os.makedirs(os.path.join(self.basedir, vm.name))
+        self.ext.desktop_menu = unittest.mock.Mock()
+        error = OSError('broken icon')
+
+        def appicons_create(vm, force=False):
+            vm.log.warning('icons of %s', vm.name)
+            if vm.name == 'test-inst-app1':
+                raise error
+            vm.log.warning('done %s', vm.name)
+
+        def run(jobs):
+            handler = logging.Handler()
+            handler.emit = unittest.mock.Mock()
+            with unittest.mock.patch.object(self.ext, 'appicons_create',
+                        side_effect=appicons_create) as create, \
+                    unittest.mock.patch.object(self.ext, 'appmenus_create'), \
+                    unittest.mock.patch.object(logging.getLogger(),
+                        'handlers', [handler]):
+                with self.assertRaises(OSError) as e:
+                    self.ext.appmenus_update_batch([tpl] + appvms,
+                                                   jobs=jobs)
+            self.assertIs(e.exception, error)
+            self.assertEqual(handler.filters, [])
+            return ([call.args[0].getMessage()
+                     for call in handler.emit.mock_calls],
+                    [call.args[0].name for call in create.mock_calls])
+
+        serial_messages, serial_created = run(1)
+        self.assertEqual(serial_messages, [
+            'icons of test-inst-tpl', 'done test-inst-tpl',
+            'icons of test-inst-app0', 'done test-inst-app0',
+            'icons of test-inst-app1'])
+        self.assertEqual(serial_created, [
+            'test-inst-tpl', 'test-inst-app0', 'test-inst-app1'])
+        parallel_messages, parallel_created = run(2)
+        self.assertEqual(parallel_messages, serial_messages)
+        # qubes already being processed when the failure is noticed are
+        # finished, but their messages are dropped
+        self.assertLessEqual(set(serial_created), set(parallel_created))
+        self.ext.desktop_menu.forceupdate.assert_not_called()
+
+    def test_170_daemon_coalesce_requests(self):
+        app = unittest.mock.MagicMock()
+        appmenus = unittest.mock.Mock()
+        daemon = qubesappmenus.daemon.AppmenusDaemon(app, appmenus)
+
+        async def run():
+            worker = asyncio.ensure_future(daemon.worker())
+            await asyncio.gather(
+                daemon.schedule('update', 'test-vm'),
+                daemon.schedule('update', 'test-vm'),
+                daemon.schedule('remove', 'test-vm2'))
+            worker.cancel()
+
+        asyncio.run(run())
+        appmenus.appmenus_update_batch.assert_called_once_with(
+            [app.domains['test-vm']], force=True)
+        appmenus.appmenus_purge.assert_called_once_with('test-vm2')
+
+    def test_171_daemon_socket(self):
+        app = unittest.mock.MagicMock()
+        appmenus = unittest.mock.Mock()
+        daemon = qubesappmenus.daemon.AppmenusDaemon(app, appmenus)
+        path = os.path.join(self.basedir, 'qubes-appmenus.sock')
+
+        async def request(line):
+            reader, writer = await asyncio.open_unix_connection(path)
+            writer.write(line)
+            response = await reader.readline()
+            writer.close()
+            return response
+
+        async def run():
+            server = asyncio.ensure_future(daemon.serve(path=path))
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+            try:
+                return [await request(b'update test-vm test-vm2\n'),
+                        await request(b'update test-vm ../test-vm\n'),
+                        await request(b'install test-vm\n')]
+            finally:
+                server.cancel()
+
+        responses = asyncio.run(run())
+        self.assertEqual(responses[0], b'ok\n')
+        self.assertTrue(responses[1].startswith(b'error '))
+        self.assertTrue(responses[2].startswith(b'error '))
+        appmenus.appmenus_update_batch.assert_called_once_with(
+            [app.domains['test-vm'], app.domains['test-vm2']], force=True)
+
 
 def list_tests():
     return (TC_00_Appmenus,)
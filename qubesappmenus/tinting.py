@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+'''Tint icons with the VM label color
+
+When NumPy is available, icons are tinted as arrays using a lookup table
+built by :py:func:`qubesimgconverter.Image.tint` itself: the tinted color
+of a pixel depends only on its lightness (``max(r, g, b) + min(r, g, b)``)
+and alpha is kept. The table is checked against the reference converter
+on a probe image before use, so the output is identical; if the check
+fails, or NumPy is missing, :py:func:`qubesimgconverter.tint` is used.
+'''
+
+import functools
+import logging
+
+import qubesimgconverter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger('qubesappmenus.tinting')
+
+
+def _lightness_probe():
+    """Image with one pixel for every lightness value (0..510)"""
+    rgba = bytearray()
+    for lightness in range(511):
+        if lightness <= 255:
+            rgba.extend((lightness, 0, 0, 255))
+        else:
+            rgba.extend((255, lightness - 255, lightness - 255, 255))
+    return qubesimgconverter.Image(bytes(rgba), (511, 1))
+
+
+def _check_probe():
+    """Image with assorted colors and alpha values"""
+    rgba = bytearray()
+    for i in range(1024):
+        rgba.extend(((i * 7) % 256, (i * 53) % 256, (i * 101) % 256,
+                     (i * 29) % 256))
+    return qubesimgconverter.Image(bytes(rgba), (32, 32))
+
+
+def _tint_array(lut, image):
+    """Tint *image* using lookup table *lut*, see :py:func:`lookup_table`"""
+    rgba = numpy.frombuffer(image.data, dtype=numpy.uint8).reshape(-1, 4)
+    rgb = rgba[:, :3].astype(numpy.uint16)
+    lightness = rgb.max(axis=1) + rgb.min(axis=1)
+    tinted = numpy.empty_like(rgba)
+    tinted[:, :3] = lut[lightness]
+    tinted[:, 3] = rgba[:, 3]
+    return qubesimgconverter.Image(tinted.tobytes(),
+                                   (image.width, image.height))
+
+
+@functools.lru_cache(maxsize=None)
+def lookup_table(color):
+    """Lookup table tinting pixels with *color*, indexed with lightness,
+    or None if the array engine cannot be used"""
+    if numpy is None:
+        return None
+    lut = numpy.frombuffer(_lightness_probe().tint(color).data,
+                           dtype=numpy.uint8).reshape(-1, 4)[:, :3].copy()
+    probe = _check_probe()
+    if _tint_array(lut, probe).data != probe.tint(color).data:
+        log.warning('Array tinting differs from qubesimgconverter, '
+                    'not using it')
+        return None
+    return lut
+
+
+def tint_file(color, src, dst):
+    """Tint icon *src* with *color* and save it as *dst*"""
+    lut = lookup_table(color)
+    if lut is None:
+        qubesimgconverter.tint(src, dst, color)
+    else:
+        _tint_array(lut,
+            qubesimgconverter.Image.load_from_file(src)).save(dst)
+
+
+def tint_many(color, paths, executor=None):
+    """Tint icons with *color*
+
+    :param color: label color, as accepted by qubesimgconverter
+    :param paths: iterable of (source path, destination path) tuples
+    :param executor: :py:class:`concurrent.futures.Executor` (usually a
+    process pool) to tint icons in parallel; if None, tint them one by one
+    """
+    paths = list(paths)
+    if executor is None or len(paths) < 2:
+        for src, dst in paths:
+            tint_file(color, src, dst)
+        return
+    # consume results to re-raise the first failure
+    list(executor.map(functools.partial(tint_file, color), *zip(*paths)))
@@ -22,17 +22,110 @@ import subprocess
 import grp
 import logging
 import asyncio
+import time
 from collections import defaultdict
 
 import qubes.ext
 from qubes.utils import sanitize_stderr_for_log
 
+from qubesappmenusext.metrics import Metrics
+
 
 class AppmenusExtension(qubes.ext.Extension):
+    #: seconds to wait for more events before updating menu of a qube;
+    #: all events within this window result in a single update
+    update_delay = 1.0
+    #: maximum number of queued menu operations processed in parallel when
+    #: a GUI VM starts
+    pending_concurrency = 4
+    #: file where metrics are written in Prometheus text format after
+    #: changes (for example for the node_exporter textfile collector), or
+    #: None to only keep them in :py:attr:`metrics`
+    metrics_path = '/run/qubes/appmenus-metrics.prom'
+    #: seconds to collect more changes before writing
+    #: :py:attr:`metrics_path`, to not block the event loop on each one
+    metrics_delay = 5.0
+
     def __init__(self, *args):
         super(AppmenusExtension, self).__init__(*args)
         self.log = logging.getLogger('appmenus')
         self.vm_tasks = defaultdict(list)
+        # names of qubes with an update scheduled, but not started yet
+        self.update_scheduled = set()
+        # at most one update in progress per qube
+        self.update_locks = defaultdict(asyncio.Lock)
+        self.metrics = Metrics()
+        # pending write of metrics_path
+        self._metrics_flush = None
+
+    def _refresh_gauges(self):
+        """Set gauges from the current state"""
+        self.metrics.set('qubes_appmenus_tasks_pending',
+            sum(len(tasks) for tasks in self.vm_tasks.values()))
+        self.metrics.set('qubes_appmenus_updates_scheduled',
+            len(self.update_scheduled))
+
+    def export_metrics(self):
+        """Refresh gauges and write metrics to :py:attr:`metrics_path` after
+        :py:attr:`metrics_delay`, unless a write is already scheduled
+
+        No async code, can be called from synchronous handlers.
+        """
+        self._refresh_gauges()
+        if self.metrics_path is None or self._metrics_flush is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop to block
+            self.flush_metrics()
+            return
+        self._metrics_flush = loop.call_later(self.metrics_delay,
+                                              self.flush_metrics)
+
+    def flush_metrics(self):
+        """Write metrics to :py:attr:`metrics_path` now"""
+        if self._metrics_flush is not None:
+            self._metrics_flush.cancel()
+            self._metrics_flush = None
+        if self.metrics_path is None:
+            return
+        self._refresh_gauges()
+        try:
+            self.metrics.export(self.metrics_path)
+        except OSError as e:
+            self.log.debug('Failed to write metrics: %s', str(e))
+
+    async def measure_rpc(self, guivm, operation, call):
+        """Await *call* of a service in *guivm*, recording its duration
+        and failure in :py:attr:`metrics`"""
+        start = time.monotonic()
+        try:
+            return await call
+        except subprocess.CalledProcessError:
+            self.metrics.inc('qubes_appmenus_updates_failed_total',
+                guivm=guivm.name, operation=operation)
+            raise
+        finally:
+            self.metrics.observe('qubes_appmenus_rpc_duration_seconds',
+                time.monotonic() - start, guivm=guivm.name,
+                operation=operation)
+            self.export_metrics()
+
+    def queue_for_guivm(self, guivm, feature, vm_name):
+        """Add *vm_name* to the queue stored in *feature* of *guivm*
+
+        No async code, to not race with other queue modifications.
+        """
+        current_queue = guivm.features.get(feature, '').split()
+        if vm_name not in current_queue:
+            current_queue.append(vm_name)
+            guivm.features[feature] = ' '.join(current_queue)
+        self.metrics.inc('qubes_appmenus_updates_queued_total',
+            guivm=guivm.name, feature=feature)
+        self.metrics.set('qubes_appmenus_pending_queue_depth',
+            len(current_queue), guivm=guivm.name, feature=feature)
+        self.export_metrics()
 
     async def run_as_user(self, command):
         """
@@ -56,58 +149,159 @@ class AppmenusExtension(qubes.ext.Extension):
         if proc.returncode != 0:
             self.log.warning('Command \'%s\' failed', ' '.join(command))
 
+    def schedule_update(self, vm):
+        """Schedule menu update after :py:attr:`update_delay`, unless one
+        is already scheduled for this qube
+
+        No async code, can be called from synchronous handlers.
+        """
+        self.collect_done_tasks(vm)
+        self.metrics.inc('qubes_appmenus_updates_requested_total')
+        if vm.name in self.update_scheduled:
+            self.metrics.inc('qubes_appmenus_updates_coalesced_total')
+            return
+        self.update_scheduled.add(vm.name)
+        self.vm_tasks[vm.name].append(
+            asyncio.ensure_future(self._delayed_update(vm)))
+        self.export_metrics()
+
+    async def _delayed_update(self, vm):
+        """Update menu of *vm* after :py:attr:`update_delay`"""
+        started = False
+        try:
+            await asyncio.sleep(self.update_delay)
+            async with self.update_locks[vm.name]:
+                # events from now on need another update
+                self.update_scheduled.discard(vm.name)
+                started = True
+                await self._update_appmenus(vm)
+        finally:
+            if not started:
+                # cancelled before the update started; once started, the
+                # flag belongs to the next scheduled update, if any
+                self.update_scheduled.discard(vm.name)
+
     async def update_appmenus(self, vm):
+        """Update menu of *vm* in its GUI VM
+
+        :return: True if done (or not needed), False if failed or queued
+        """
+        self.metrics.inc('qubes_appmenus_updates_requested_total')
+        async with self.update_locks[vm.name]:
+            return await self._update_appmenus(vm)
+
+    async def _update_appmenus(self, vm):
+        """Update menu of *vm*, the caller holds its update lock"""
         guivm = vm.guivm
         if not guivm:
             self.log.warning("VM for '%s' does not have GUI VM, not updating menu", vm.name)
-            return
+            return True
         if not guivm.is_running():
             self.log.warning("GUI VM for '%s' is not running, queueing menu update", vm.name)
-            # please no async code between those two calls
-            current_queue = guivm.features.get('menu-update-pending-for', '').split()
-            if vm.name not in current_queue:
-                guivm.features['menu-update-pending-for'] = ' '.join(current_queue + [vm.name])
-            return
+            self.queue_for_guivm(guivm, 'menu-update-pending-for', vm.name)
+            return False
         self.log.info("Updating appmenus for '%s' in '%s'", vm.name, guivm.name)
-        if guivm.klass == 'AdminVM' or guivm.features.check_with_template("supported-rpc.qubes.UpdateAppMenusFor", None):
+        if self.supports_rpc(guivm, "qubes.UpdateAppMenusFor"):
             try:
-                await guivm.run_service_for_stdio("qubes.UpdateAppMenusFor+" + vm.name)
+                await self.measure_rpc(guivm, 'update',
+                    guivm.run_service_for_stdio(
+                        "qubes.UpdateAppMenusFor+" + vm.name))
             except subprocess.CalledProcessError as e:
                 self.log.error("Failed to update appmenus for '%s' in '%s': %s",
                     vm.name, guivm.name, sanitize_stderr_for_log(e.stderr))
+                return False
         else:
             # older desktop-linux-common
             try:
-                await guivm.run_for_stdio("qvm-appmenus --update --quiet --force -- " + vm.name)
+                await self.measure_rpc(guivm, 'update', guivm.run_for_stdio(
+                    "qvm-appmenus --update --quiet --force -- " + vm.name))
             except subprocess.CalledProcessError as e:
                 self.log.error("Failed to update appmenus for '%s' in '%s': %s",
                     vm.name, guivm.name, sanitize_stderr_for_log(e.stderr))
+                return False
+        return True
+
+    @staticmethod
+    def supports_rpc(guivm, service):
+        """Check if *guivm* provides given appmenus service"""
+        return guivm.klass == 'AdminVM' or \
+            guivm.features.check_with_template(
+                "supported-rpc." + service, None)
+
+    async def update_appmenus_many(self, vms, guivm):
+        """Update appmenus of many qubes
+
+        Qubes using *guivm* are updated with a single
+        qubes.UpdateAppMenusForMany call, if the GUI VM supports it. All the
+        others are updated one by one.
+
+        :return: names of qubes with menu updated (or not needing update)
+        """
+        updated = []
+        for vm in vms:
+            if vm.guivm != guivm and await self.update_appmenus(vm):
+                updated.append(vm.name)
+        vms = [vm for vm in vms if vm.guivm == guivm]
+        if len(vms) < 2 or not guivm.is_running() or not \
+                self.supports_rpc(guivm, "qubes.UpdateAppMenusForMany"):
+            for vm in vms:
+                if await self.update_appmenus(vm):
+                    updated.append(vm.name)
+            return updated
+        vm_names = sorted(vm.name for vm in vms)
+        async with contextlib.AsyncExitStack() as stack:
+            # always lock in the same order, to avoid deadlocks
+            for vm_name in vm_names:
+                await stack.enter_async_context(self.update_locks[vm_name])
+            self.log.info("Updating appmenus for %d qubes in '%s'",
+                len(vm_names), guivm.name)
+            self.metrics.inc('qubes_appmenus_updates_requested_total',
+                len(vm_names))
+            try:
+                await self.measure_rpc(guivm, 'update-many',
+                    guivm.run_service_for_stdio(
+                        "qubes.UpdateAppMenusForMany",
+                        input=''.join(
+                            name + '\n' for name in vm_names).encode()))
+            except subprocess.CalledProcessError as e:
+                self.log.error("Failed to update appmenus for %s in '%s': %s",
+                    ', '.join(vm_names), guivm.name,
+                    sanitize_stderr_for_log(e.stderr))
+                return updated
+        return updated + vm_names
 
     async def remove_appmenus(self, vm_name, guivm):
+        """Remove menu of *vm_name* from *guivm*
+
+        :return: True if done (or not needed), False if failed or queued
+        """
         if not guivm:
             self.log.warning("VM for '%s' does not have GUI VM, not removing menu", vm_name)
-            return
+            return True
         if not guivm.is_running():
             self.log.warning("GUI VM for '%s' is not running, queueing menu removal", vm_name)
-            # please no async code between those two calls
-            current_queue = guivm.features.get('menu-remove-pending-for', '').split()
-            if vm_name not in current_queue:
-                guivm.features['menu-remove-pending-for'] = ' '.join(current_queue + [vm_name])
-            return
+            self.queue_for_guivm(guivm, 'menu-remove-pending-for', vm_name)
+            return False
         self.log.info("Removing appmenus for '%s' in '%s'", vm_name, guivm.name)
-        if guivm.klass == 'AdminVM' or guivm.features.check_with_template("supported-rpc.qubes.RemoveAppMenusFor", None):
+        if self.supports_rpc(guivm, "qubes.RemoveAppMenusFor"):
             try:
-                await guivm.run_service_for_stdio("qubes.RemoveAppMenusFor+" + vm_name)
+                await self.measure_rpc(guivm, 'remove',
+                    guivm.run_service_for_stdio(
+                        "qubes.RemoveAppMenusFor+" + vm_name))
             except subprocess.CalledProcessError as e:
                 self.log.error("Failed to remove appmenus for '%s' in '%s': %s",
                     vm_name, guivm.name, sanitize_stderr_for_log(e.stderr))
+                return False
         else:
             # older desktop-linux-common
             try:
-                await guivm.run_for_stdio("qvm-appmenus --remove --quiet -- " + vm_name)
+                await self.measure_rpc(guivm, 'remove', guivm.run_for_stdio(
+                    "qvm-appmenus --remove --quiet -- " + vm_name))
             except subprocess.CalledProcessError as e:
                 self.log.error("Failed to remove appmenus for '%s' in '%s': %s",
                     vm_name, guivm.name, sanitize_stderr_for_log(e.stderr))
+                return False
+        return True
 
     @qubes.ext.handler('domain-create-on-disk')
     async def create_on_disk(self, vm, event):
@@ -127,6 +321,7 @@ class AppmenusExtension(qubes.ext.Extension):
         await asyncio.gather(*tasks, return_exceptions=True)
         with contextlib.suppress(KeyError):
             del self.vm_tasks[vm.name]
+        self.export_metrics()
 
     def collect_done_tasks(self, vm):
         """Collect only done tasks, no async code"""
@@ -153,23 +348,20 @@ class AppmenusExtension(qubes.ext.Extension):
         # wait for any pending appmenu operations to complete
         # before removing appmenus
         await self.collect_pending_tasks(vm)
+        self.update_locks.pop(vm.name, None)
         await self.remove_appmenus(vm.name, vm.guivm)
 
     @qubes.ext.handler('property-set:label')
     def label_setter(self, vm, event, **kwargs):
         if vm.app.vmm.offline_mode:
             return
-        self.collect_done_tasks(vm)
-        self.vm_tasks[vm.name].append(
-            asyncio.ensure_future(self.update_appmenus(vm)))
+        self.schedule_update(vm)
 
     @qubes.ext.handler('property-set:provides_network')
     def provides_network_setter(self, vm, event, **kwargs):
         if vm.app.vmm.offline_mode:
             return
-        self.collect_done_tasks(vm)
-        self.vm_tasks[vm.name].append(
-            asyncio.ensure_future(self.update_appmenus(vm)))
+        self.schedule_update(vm)
 
     @qubes.ext.handler('property-set:template_for_dispvms')
     def template_for_dispvms_setter(self, vm, event, **kwargs):
@@ -177,9 +369,7 @@ class AppmenusExtension(qubes.ext.Extension):
             return
         if not vm.features.get('appmenus-dispvm', False):
             return
-        self.collect_done_tasks(vm)
-        self.vm_tasks[vm.name].append(
-            asyncio.ensure_future(self.update_appmenus(vm)))
+        self.schedule_update(vm)
 
     @qubes.ext.handler('property-set:guivm')
     def provides_network_setter(self, vm, event, name, newvalue, oldvalue=None):
@@ -189,8 +379,7 @@ class AppmenusExtension(qubes.ext.Extension):
         if oldvalue and oldvalue != newvalue:
             self.vm_tasks[vm.name].append(
                 asyncio.ensure_future(self.remove_appmenus(vm.name, oldvalue)))
-        self.vm_tasks[vm.name].append(
-            asyncio.ensure_future(self.update_appmenus(vm)))
+        self.schedule_update(vm)
 
     @qubes.ext.handler('domain-feature-delete:appmenus-dispvm')
     def on_feature_del_appmenus_dispvm(self, vm, event, feature):
@@ -198,9 +387,7 @@ class AppmenusExtension(qubes.ext.Extension):
             return
         if not getattr(vm, 'template_for_dispvms', False):
             return
-        self.collect_done_tasks(vm)
-        self.vm_tasks[vm.name].append(
-            asyncio.ensure_future(self.update_appmenus(vm)))
+        self.schedule_update(vm)
 
     @qubes.ext.handler('domain-feature-set:appmenus-dispvm')
     def on_feature_set_appmenus_dispvm(self, vm, event, feature,
@@ -209,26 +396,20 @@ class AppmenusExtension(qubes.ext.Extension):
             return
         if not getattr(vm, 'template_for_dispvms', False):
             return
-        self.collect_done_tasks(vm)
-        self.vm_tasks[vm.name].append(
-            asyncio.ensure_future(self.update_appmenus(vm)))
+        self.schedule_update(vm)
 
     @qubes.ext.handler('domain-feature-set:menu-items')
     def on_feature_set_menu_items(self, vm, event, feature,
             value, oldvalue=None):
         if vm.app.vmm.offline_mode:
             return
-        self.collect_done_tasks(vm)
-        self.vm_tasks[vm.name].append(
-            asyncio.ensure_future(self.update_appmenus(vm)))
+        self.schedule_update(vm)
 
     @qubes.ext.handler('domain-feature-delete:internal')
     def on_feature_del_internal(self, vm, event, feature):
         if vm.app.vmm.offline_mode:
             return
-        self.collect_done_tasks(vm)
-        self.vm_tasks[vm.name].append(
-            asyncio.ensure_future(self.update_appmenus(vm)))
+        self.schedule_update(vm)
 
     @qubes.ext.handler('domain-feature-set:internal')
     def on_feature_set_internal(self, vm, event, feature, value,
@@ -240,6 +421,47 @@ class AppmenusExtension(qubes.ext.Extension):
             self.vm_tasks[vm.name].append(
                 asyncio.ensure_future(self.remove_appmenus(vm.name, vm.guivm)))
 
+    def dequeue(self, guivm, feature, vm_name):
+        """Remove *vm_name* from the queue stored in *feature* of *guivm*
+
+        No async code, to not race with other queue modifications.
+        """
+        queue = guivm.features.get(feature, '').split()
+        if vm_name not in queue:
+            return
+        queue.remove(vm_name)
+        if queue:
+            guivm.features[feature] = ' '.join(queue)
+        else:
+            del guivm.features[feature]
+        self.metrics.set('qubes_appmenus_pending_queue_depth', len(queue),
+            guivm=guivm.name, feature=feature)
+        self.export_metrics()
+
+    async def process_queue(self, guivm, feature, vm_names, func):
+        """Call *func* for each of *vm_names*, at most
+        :py:attr:`pending_concurrency` at a time, and remove each name from
+        the queue in *feature* of *guivm* as soon as it is processed
+
+        Names for which *func* failed (raised an exception or returned a
+        false value) stay in the queue.
+        """
+        semaphore = asyncio.Semaphore(self.pending_concurrency)
+
+        async def process(vm_name):
+            async with semaphore:
+                try:
+                    done = await func(vm_name)
+                except Exception as e:  # pylint: disable=broad-except
+                    self.log.error(
+                        "Failed to process queued menu operation for '%s' "
+                        "in '%s': %s", vm_name, guivm.name, str(e))
+                    return
+            if done:
+                self.dequeue(guivm, feature, vm_name)
+
+        await asyncio.gather(*(process(vm_name) for vm_name in vm_names))
+
     @qubes.ext.handler('domain-start')
     async def on_domain_start(self, vm, event, **kwargs):
         """Process queued menu updates"""
@@ -247,18 +469,31 @@ class AppmenusExtension(qubes.ext.Extension):
         pending_update = vm.features.get('menu-update-pending-for', '').split()
         if pending_remove:
             vm.log.info("Processing pending menu removals")
-            for to_remove in pending_remove:
-                await self.remove_appmenus(to_remove, guivm=vm)
-            del vm.features['menu-remove-pending-for']
+            await self.process_queue(vm, 'menu-remove-pending-for',
+                pending_remove,
+                lambda vm_name: self.remove_appmenus(vm_name, guivm=vm))
         if pending_update:
             vm.log.info("Processing pending menu updates")
             for to_update in pending_update:
                 if to_update not in vm.app.domains:
                     # removed in the meantime, and should be handled
-                    # by the loop above
-                    continue
-                await self.update_appmenus(vm.app.domains[to_update])
-            del vm.features['menu-update-pending-for']
+                    # by the removals above
+                    self.dequeue(vm, 'menu-update-pending-for', to_update)
+            pending_update = [to_update for to_update in pending_update
+                              if to_update in vm.app.domains]
+            if len(pending_update) > 1 and \
+                    self.supports_rpc(vm, "qubes.UpdateAppMenusForMany"):
+                updated = await self.update_appmenus_many(
+                    [vm.app.domains[to_update]
+                     for to_update in pending_update],
+                    guivm=vm)
+                for to_update in updated:
+                    self.dequeue(vm, 'menu-update-pending-for', to_update)
+            else:
+                await self.process_queue(vm, 'menu-update-pending-for',
+                    pending_update,
+                    lambda vm_name: self.update_appmenus(
+                        vm.app.domains[vm_name]))
 
     @qubes.ext.handler('domain-shutdown')
     async def on_domain_shutdown(self, vm, event, **kwargs):
@@ -0,0 +1,135 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+"""Metrics of the appmenus extension, in Prometheus text format"""
+from collections import defaultdict
+
+import qubesappmenus.atomicfile
+
+#: name -> (type, help) of all the metrics
+METRICS = {
+    'qubes_appmenus_updates_requested_total': (
+        'counter', 'Menu updates requested, by qube events or directly'),
+    'qubes_appmenus_updates_coalesced_total': (
+        'counter', 'Menu update requests merged into an already scheduled '
+                   'update'),
+    'qubes_appmenus_updates_queued_total': (
+        'counter', 'Menu operations queued because the GUI VM was not '
+                   'running'),
+    'qubes_appmenus_updates_failed_total': (
+        'counter', 'Menu operations that failed in the GUI VM'),
+    'qubes_appmenus_rpc_duration_seconds': (
+        'histogram', 'Duration of menu operation calls to GUI VMs'),
+    'qubes_appmenus_pending_queue_depth': (
+        'gauge', 'Qubes queued in menu-update-pending-for and '
+                 'menu-remove-pending-for features of GUI VMs'),
+    'qubes_appmenus_tasks_pending': (
+        'gauge', 'Menu operations in progress or waiting'),
+    'qubes_appmenus_updates_scheduled': (
+        'gauge', 'Qubes with a menu update scheduled, but not started'),
+}
+
+#: upper bounds of histogram buckets, in seconds
+BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+
+def _format_labels(labels):
+    """Labels (tuple of (name, value) pairs) in exposition format"""
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in labels) + '}'
+
+
+def _format_value(value):
+    """Sample value in exposition format"""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics(object):
+    """Counters, gauges and histograms, identified by name and labels
+
+    Labels are given as keyword arguments.
+    """
+
+    def __init__(self):
+        #: (name, labels) -> value
+        self.values = defaultdict(int)
+        #: (name, labels) -> [count per bucket, sum, count]
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        """Key of metric *name* with *labels* (dict)"""
+        assert name in METRICS, name
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """Increase counter *name*"""
+        self.values[self._key(name, labels)] += value
+
+    def set(self, name, value, **labels):
+        """Set gauge *name*"""
+        self.values[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        """Record *value* in histogram *name*"""
+        key = self._key(name, labels)
+        if key not in self.histograms:
+            self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+        histogram = self.histograms[key]
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def render(self):
+        """All the metrics in Prometheus text exposition format"""
+        lines = []
+        for name, (metric_type, metric_help) in METRICS.items():
+            lines.append('# HELP {} {}'.format(name, metric_help))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            if metric_type == 'histogram':
+                for (hist_name, labels), (buckets, total, count) in sorted(
+                        self.histograms.items()):
+                    if hist_name != name:
+                        continue
+                    for bound, bucket_count in zip(BUCKETS, buckets):
+                        lines.append('{}_bucket{} {}'.format(
+                            name,
+                            _format_labels(
+                                labels + (('le', _format_value(bound)),)),
+                            bucket_count))
+                    lines.append('{}_sum{} {}'.format(
+                        name, _format_labels(labels), _format_value(total)))
+                    lines.append('{}_count{} {}'.format(
+                        name, _format_labels(labels), count))
+                continue
+            for (value_name, labels), value in sorted(self.values.items()):
+                if value_name == name:
+                    lines.append('{}{} {}'.format(
+                        name, _format_labels(labels), _format_value(value)))
+        return ''.join(line + '\n' for line in lines)
+
+    def export(self, path):
+        """Atomically write :py:meth:`render` output to *path*, for example
+        for the node_exporter textfile collector"""
+        qubesappmenus.atomicfile.write_file(path, self.render())
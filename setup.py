@@ -22,6 +22,7 @@ if __name__ == '__main__':
             'console_scripts': [
                 'qvm-sync-appmenus = qubesappmenus.receive:main',
                 'qvm-appmenus = qubesappmenus:main',
+                'qvm-appmenus-daemon = qubesappmenus.daemon:main',
             ],
             'qubes.ext': [
                 'qubesappmenus = qubesappmenusext:AppmenusExtension',
@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+'''Benchmark of the appmenus pipeline on a synthetic fleet of qubes
+
+Runs offline: qubes are simulated in-process (property reads are counted
+as admin API calls), icons are generated, and ``xdg-desktop-menu`` is a
+stub script that does nothing. All files are created in a temporary
+directory. It is a development tool, not installed with the package. Run
+from the source tree::
+
+    PYTHONPATH=. python3 tools/appmenus_benchmark.py \
+        --templates 3 --appvms 10 --entries 40
+
+For each phase, wall time, spawned subprocesses, file operations (opened,
+stat-ed, listed, renamed, linked and removed files, in this process only),
+property reads and peak RSS of the process so far are reported.
+'''
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import unittest.mock
+
+import xdg.BaseDirectory
+
+import qubesappmenus
+import qubesappmenus.desktopmenu
+import qubesappmenus.receive
+
+#: functions counted as file operations
+FILE_OPS = ('builtins.open', 'os.stat', 'os.listdir', 'os.replace',
+            'os.rename', 'os.link', 'os.unlink')
+
+log = logging.getLogger('qubesappmenus.benchmark')
+
+
+class Label(object):
+    """Label of simulated qubes"""
+    # pylint: disable=too-few-public-methods
+    def __init__(self, index, color, name):
+        self.index = index
+        self.color = color
+        self.name = name
+        self.icon = name + '.png'
+
+
+class Features(dict):
+    """Features of a simulated qube"""
+    def __init__(self, vm):
+        super().__init__()
+        self.vm = vm
+
+    def check_with_template(self, feature, default=None):
+        """Feature value of the qube or its template"""
+        self.vm.app.property_reads += 1
+        if feature in self:
+            return self[feature]
+        if hasattr(self.vm, 'template'):
+            return self.vm.template.features.check_with_template(feature,
+                                                                 default)
+        return default
+
+
+class App(object):
+    """Simulated ``qubesadmin.Qubes``"""
+    # pylint: disable=too-few-public-methods
+    local_name = 'dom0'
+
+    def __init__(self):
+        self.domains = {}
+        self.labels = {1: Label(1, '0xcc0000', 'red')}
+        #: number of qube properties read, each being an admin API call
+        #: for a real qube
+        self.property_reads = 0
+
+
+class VM(object):
+    """Simulated qube, counting reads of its properties"""
+
+    def __init__(self, app, name, icon_size, **properties):
+        self.app = app
+        self.name = name
+        self.icon_size = icon_size
+        self.log = log
+        self.features = Features(self)
+        self._properties = properties
+        app.domains[name] = self
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        self.app.property_reads += 1
+        try:
+            return self._properties[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __str__(self):
+        return self.name
+
+    def based_on(self, vm):
+        """Whether this qube is based on *vm*, not counted as a property
+        read"""
+        return self._properties.get('template') is vm
+
+    @property
+    def icon(self):
+        """Icon name, like in qubesadmin"""
+        self.app.property_reads += 1
+        prefix = {'TemplateVM': 'templatevm', 'DispVM': 'dispvm'}.get(
+            self._properties['klass'], 'appvm')
+        return prefix + '-' + self._properties['label'].name
+
+    @property
+    def appvms(self):
+        """Qubes based on this one"""
+        return [vm for vm in self.app.domains.values()
+                if vm.based_on(self)]
+
+    def is_running(self):
+        """Simulated qubes are always running"""
+        return True
+
+    def run_service(self, service, **kwargs):
+        """Answer icon services, see :py:class:`ServiceCall`"""
+        # pylint: disable=unused-argument
+        return ServiceCall(service, self.icon_size)
+
+
+class ServiceCall(object):
+    """Simulated call of ``qubes.GetImageRGBA``, answering with generated
+    icons"""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, service, icon_size):
+        self.service = service
+        self.icon_size = icon_size
+        self.stdin = io.BytesIO()
+        self.stdin.close = self._answer
+        self.stdout = None
+        self.returncode = 0
+
+    def _answer(self):
+        """Write icons requested on stdin to stdout, called on stdin
+        close"""
+        names = self.stdin.getvalue().decode().splitlines()
+        stdout = io.BytesIO()
+        for name in names:
+            name = name.split(':', 1)[-1]
+            stdout.write(generate_icon(name, self.icon_size))
+        stdout.seek(0)
+        self.stdout = stdout
+
+    def wait(self):
+        """Service always succeeds"""
+        return self.returncode
+
+
+def generate_icon(name, size):
+    """Icon in the ``qubes.GetImageRGBA`` format, different for each
+    *name*"""
+    seed = hashlib.sha256(name.encode()).digest()
+    rgba = bytearray()
+    for row in range(size):
+        for col in range(size):
+            rgba.extend(((col * 5 + seed[0]) % 256, (row * 3 + seed[1]) % 256,
+                         (col ^ row ^ seed[2]) % 256,
+                         (col + row) * 255 // size % 256))
+    return '{0} {0}\n'.format(size).encode() + bytes(rgba)
+
+
+def generate_appmenus(template_index, entries):
+    """Entries as parsed by :py:func:`qubesappmenus.receive.get_appmenus`"""
+    appmenus = {}
+    for i in range(entries):
+        name = 'org.example.app{}'.format(i)
+        appmenus[name] = {
+            'Name': 'Application {}'.format(i),
+            'GenericName': 'Example {}'.format(i),
+            'Comment': 'Synthetic application {} of template {}'.format(
+                i, template_index),
+            'Categories': 'Utility;',
+            'Exec': 'qubes-desktop-run '
+                    '/usr/share/applications/{}.desktop'.format(name),
+            # some icons are shared between entries
+            'Icon': 'icon{}'.format(i % max(1, entries * 3 // 4)),
+        }
+    return appmenus
+
+
+def generate_fleet(app, templates, appvms, icon_size):
+    """Create *templates* templates with *appvms* AppVMs each
+
+    :return: tuple of (list of templates, list of AppVMs)
+    """
+    label = app.labels[1]
+    template_vms = []
+    app_vms = []
+    for i in range(templates):
+        tpl = VM(app, 'bench-tpl-{}'.format(i), icon_size,
+                 klass='TemplateVM', label=label, provides_network=False,
+                 template_for_dispvms=False, guivm=app.local_name)
+        template_vms.append(tpl)
+        for j in range(appvms):
+            app_vms.append(VM(
+                app, 'bench-app-{}-{}'.format(i, j), icon_size,
+                klass='AppVM', template=tpl, label=label,
+                provides_network=False, template_for_dispvms=False,
+                guivm=app.local_name))
+    return template_vms, app_vms
+
+
+class Counters(object):
+    """Count subprocesses and file operations within the context"""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self.subprocesses = 0
+        self.file_ops = 0
+
+    @contextlib.contextmanager
+    def counting(self):
+        """Patch counted functions"""
+        with contextlib.ExitStack() as stack:
+            mocks = [stack.enter_context(unittest.mock.patch(
+                name, wraps=_resolve(name))) for name in FILE_OPS]
+            popen = stack.enter_context(unittest.mock.patch(
+                'subprocess.Popen', wraps=subprocess.Popen))
+            try:
+                yield self
+            finally:
+                self.file_ops += sum(mock.call_count for mock in mocks)
+                self.subprocesses += popen.call_count
+
+
+def _resolve(name):
+    """Function *name* (``module.function``), before patching"""
+    module, attr = name.rsplit('.', 1)
+    return getattr(sys.modules[module], attr)
+
+
+def peak_rss():
+    """Peak RSS of this process so far, in KiB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_phase(app, name, func, items):
+    """Run *func* for each of *items*, return the measurements"""
+    counters = Counters()
+    property_reads = app.property_reads
+    start = time.perf_counter()
+    with counters.counting():
+        for item in items:
+            func(item)
+    return {
+        'phase': name,
+        'seconds': round(time.perf_counter() - start, 6),
+        'subprocesses': counters.subprocesses,
+        'file_ops': counters.file_ops,
+        'property_reads': app.property_reads - property_reads,
+        'peak_rss_kib': peak_rss(),
+    }
+
+
+def run(args, tmpdir):
+    """Generate a fleet in *tmpdir* and measure all the phases"""
+    app = App()
+    templates, appvms = generate_fleet(app, args.templates, args.appvms,
+                                       args.icon_size)
+    all_vms = templates + appvms
+    if args.xdg_desktop_menu:
+        desktop_menu = qubesappmenus.desktopmenu.XdgDesktopMenu()
+    else:
+        desktop_menu = qubesappmenus.desktopmenu.NativeDesktopMenu()
+    appmenus = qubesappmenus.Appmenus(desktop_menu=desktop_menu,
+                                      tint_jobs=args.tint_jobs)
+
+    def process_templates(vm):
+        qubesappmenus.receive.process_appmenus_templates(
+            appmenus, vm, generate_appmenus(templates.index(vm),
+                                            args.entries))
+
+    def get_available(vm):
+        for _ in appmenus.get_available(vm, fields=['Comment']):
+            pass
+
+    phases = [
+        ('appmenus_init', appmenus.appmenus_init, all_vms),
+        ('process_appmenus_templates', process_templates, templates),
+        ('appicons_create', appmenus.appicons_create, all_vms),
+        ('appmenus_create',
+         lambda vm: appmenus.appmenus_create(vm, refresh_cache=False),
+         all_vms),
+        ('get_available', get_available, all_vms),
+        ('appmenus_update', appmenus.appmenus_update, templates),
+        ('appmenus_update (forced)',
+         lambda vm: appmenus.appmenus_update(vm, force=True), templates),
+    ]
+    results = []
+    with unittest.mock.patch('qubesappmenus.basedir', tmpdir):
+        for name, func, items in phases:
+            results.append(run_phase(app, name, func, items))
+    return results
+
+
+def prepare_environment(tmpdir):
+    """Stub ``xdg-desktop-menu`` and keep desktop files in *tmpdir*"""
+    bindir = os.path.join(tmpdir, 'bin')
+    os.mkdir(bindir)
+    stub = os.path.join(bindir, 'xdg-desktop-menu')
+    with open(stub, 'w', encoding='utf-8') as stub_f:
+        stub_f.write('#!/bin/sh\nexit 0\n')
+    os.chmod(stub, 0o755)
+    os.environ['PATH'] = bindir + os.pathsep + os.environ.get('PATH', '')
+    # do not call kbuildsycoca
+    os.environ.pop('KDE_SESSION_UID', None)
+    xdg.BaseDirectory.xdg_data_home = os.path.join(tmpdir, 'data')
+    xdg.BaseDirectory.xdg_config_home = os.path.join(tmpdir, 'config')
+    basedir = os.path.join(tmpdir, 'appmenus')
+    os.mkdir(basedir)
+    return basedir
+
+
+parser = argparse.ArgumentParser(
+    description='Benchmark appmenus on a synthetic fleet of qubes')
+parser.add_argument('--templates', type=int, default=2,
+    help='number of templates (default: %(default)s)')
+parser.add_argument('--appvms', type=int, default=10,
+    help='number of AppVMs based on each template (default: %(default)s)')
+parser.add_argument('--entries', type=int, default=30,
+    help='number of menu entries of each template (default: %(default)s)')
+parser.add_argument('--icon-size', type=int, default=48,
+    help='size of generated icons, in pixels (default: %(default)s)')
+parser.add_argument('--tint-jobs', type=int, default=None,
+    help='number of processes tinting icons (default: number of CPUs)')
+parser.add_argument('--xdg-desktop-menu', action='store_true',
+    help='register entries with (stubbed) xdg-desktop-menu instead of the '
+         'native backend')
+parser.add_argument('--json', action='store_true',
+    help='print results as JSON lines')
+
+
+def main(args=None):
+    """Run the benchmark and print results"""
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results = run(args, prepare_environment(tmpdir))
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+        return
+    print('{:<28} {:>9} {:>6} {:>9} {:>8} {:>10}'.format(
+        'phase', 'seconds', 'procs', 'file ops', 'props', 'RSS KiB'))
+    for result in results:
+        print('{phase:<28} {seconds:>9.3f} {subprocesses:>6} '
+              '{file_ops:>9} {property_reads:>8} {peak_rss_kib:>10}'.format(
+                **result))
+
+
+if __name__ == '__main__':
+    sys.exit(main())